@@ -0,0 +1,44 @@
+import threading
+
+import config
+
+# Per process AWS resources. Workers set them up once in worker_process_init,
+# anything else builds them on first use. boto3 takes a while to import and
+# the api only needs it for price lookups, so it is imported on first use too.
+
+_clients = {}
+_clients_lock = threading.Lock()
+_region_names = None
+
+
+def load_region_names():
+    return {
+        code: region["description"].replace("Europe", "EU")
+        for code, region in config.load_region_map().items()
+    }
+
+def init():
+    global _clients, _region_names
+    # clients must not be shared with the parent of a forked process
+    _clients = {}
+    _region_names = load_region_names()
+    get_client("pricing", "us-east-1")
+
+def get_region_name(region):
+    global _region_names
+    if _region_names is None:
+        _region_names = load_region_names()
+    return _region_names[region]
+
+def get_client(service, region):
+    key = (service, region)
+    client = _clients.get(key)
+    if client is None:
+        # clients are thread safe, creating them from the default session is not
+        with _clients_lock:
+            client = _clients.get(key)
+            if client is None:
+                import boto3
+
+                client = _clients[key] = boto3.client(service, region_name=region)
+    return client
@@ -0,0 +1,168 @@
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime
+
+import aws
+import crud
+import database
+import worker
+from enums import CostEngine
+
+logger = logging.getLogger(__name__)
+
+# Recomputes the costs of finished containers, e.g. after prices were
+# corrected or the cost calculation changed. Applications are sharded across
+# a process pool, every application is costed in chunks of containers read
+# from a server side cursor and written with one upsert per chunk, then its
+# summary is rebuilt. Finished applications are recorded in a checkpoint file,
+# a rerun with the same arguments skips them.
+#
+#   python backfill.py --start 2024-01-01 --end 2024-02-01 --checkpoint january.json
+#   python backfill.py --applications application_1700000000000_0001 --engine counters
+#
+# Prices go through the usual caches, set PRICE_CACHE_URL to share them
+# between the processes or PRICE_SNAPSHOT_PATH to cost without AWS calls.
+
+CHUNK_SIZE = 1000
+
+
+class Checkpoint:
+    def __init__(self, path: str | None, params: dict):
+        self.path = path
+        self.params = params
+        self.done = set()
+        self.failed = {}
+        if path is None or not os.path.exists(path):
+            return
+        with open(path) as f:
+            data = json.load(f)
+        if data["params"] != params:
+            raise SystemExit(f"Checkpoint {path} was written for other arguments: {data['params']}")
+        self.done = set(data["done"])
+
+    def record(self, application_id: int, error: str | None = None):
+        if error is None:
+            self.done.add(application_id)
+            self.failed.pop(application_id, None)
+        else:
+            self.failed[application_id] = error
+
+    def save(self):
+        if self.path is None:
+            return
+        # written to a temporary file first, an interrupted run keeps the
+        # previous checkpoint
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"params": self.params, "done": sorted(self.done), "failed": self.failed}, f)
+        os.replace(tmp, self.path)
+
+
+def init_process():
+    # connections inherited from the parent process can't be used after fork
+    database.engine.dispose(close=False)
+    aws.init()
+
+def recompute_application(session, application_id: int, chunk_size: int):
+    costed = 0
+    for containers in crud.stream_finished_containers(session, application_id, chunk_size):
+        costed += len(worker.process_application_containers(session, containers))
+    crud.rebuild_application_summaries(session, [application_id])
+    return costed
+
+def recompute_applications(application_ids: list[int], chunk_size: int):
+    # one transaction per application, a failing one doesn't undo the others
+    results = []
+    session = next(database.get_db())
+    try:
+        for application_id in application_ids:
+            try:
+                costed = recompute_application(session, application_id, chunk_size)
+                session.commit()
+                results.append((application_id, costed, None))
+            except Exception as e:
+                session.rollback()
+                results.append((application_id, 0, f"{type(e).__name__}: {e}"))
+    finally:
+        session.close()
+    return results
+
+def shards(application_ids: list[int], size: int):
+    for i in range(0, len(application_ids), size):
+        yield application_ids[i:i + size]
+
+def backfill(application_ids: list[int], checkpoint: Checkpoint, processes: int, shard_size: int, chunk_size: int):
+    start = time.monotonic()
+    applications = costed = 0
+
+    def collect(futures):
+        nonlocal applications, costed
+        for future in futures:
+            for application_id, count, error in future.result():
+                checkpoint.record(application_id, error)
+                if error is not None:
+                    logger.warning("Application %d failed: %s", application_id, error)
+                    continue
+                applications += 1
+                costed += count
+        checkpoint.save()
+        elapsed = time.monotonic() - start
+        logger.info("%d/%d applications, %d containers costed, %.0f containers/s",
+                    applications, len(application_ids), costed, costed / elapsed if elapsed else 0)
+
+    with ProcessPoolExecutor(processes, initializer=init_process) as pool:
+        pending = set()
+        for shard in shards(application_ids, shard_size):
+            # a few shards per process in flight, the checkpoint follows closely
+            if len(pending) >= processes * 2:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                collect(done)
+            pending.add(pool.submit(recompute_applications, shard, chunk_size))
+        collect(wait(pending).done)
+    return applications, costed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recompute the costs of finished containers.")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="applications started at or after")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="applications started before")
+    parser.add_argument("--applications", nargs="+", help="application names")
+    parser.add_argument("--engine", choices=[engine.value for engine in CostEngine], help="overrides COST_ENGINE")
+    parser.add_argument("--processes", type=int, default=os.cpu_count())
+    parser.add_argument("--shard-size", type=int, default=10, help="applications per task")
+    parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="containers per upsert")
+    parser.add_argument("--checkpoint", help="JSON file recording finished applications")
+    args = parser.parse_args()
+    if args.start is None and args.end is None and args.applications is None:
+        parser.error("give a date range or application names")
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    if args.engine is not None:
+        # read by the cost functions, inherited by the processes
+        os.environ["COST_ENGINE"] = args.engine
+
+    checkpoint = Checkpoint(args.checkpoint, {
+        "start": args.start and args.start.isoformat(),
+        "end": args.end and args.end.isoformat(),
+        "applications": args.applications,
+        "engine": args.engine,
+    })
+    session = next(database.get_db())
+    try:
+        application_ids = crud.get_application_ids(session, args.start, args.end, args.applications)
+    finally:
+        session.close()
+    # nothing may be left in the pool when the processes fork
+    database.engine.dispose()
+
+    todo = [application_id for application_id in application_ids if application_id not in checkpoint.done]
+    logger.info("%d applications, %d done before", len(application_ids), len(application_ids) - len(todo))
+    applications, costed = backfill(todo, checkpoint, args.processes, args.shard_size, args.chunk_size)
+    logger.info("Done, %d applications and %d containers costed, %d applications failed",
+                applications, costed, len(checkpoint.failed))
+    if checkpoint.failed:
+        raise SystemExit(1)
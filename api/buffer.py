@@ -0,0 +1,113 @@
+import asyncio
+import logging
+from collections import defaultdict
+
+from starlette.concurrency import run_in_threadpool
+
+import crud
+import crud_async
+import database
+import schema
+
+logger = logging.getLogger(__name__)
+
+
+class BufferFull(Exception):
+    pass
+
+
+def write_usages(instance_id: str, usage_schemas: list[schema.UsageCreate]):
+    db = database.SessionLocal()
+    try:
+        crud.create_usages(db, instance_id, usage_schemas)
+        db.commit()
+    finally:
+        db.close()
+
+async def write_usages_async(instance_id: str, usage_schemas: list[schema.UsageCreate]):
+    async with database.AsyncSessionLocal() as db:
+        await crud_async.create_usages(db, instance_id, usage_schemas)
+        await db.commit()
+
+
+class UsageBuffer:
+    def __init__(self, max_size: int, flush_interval: float, flush_rows: int):
+        self.max_size = max_size
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self._items = []
+        self._in_flight = 0
+        self._stopping = False
+        self._task = None
+        self._flush_requested = None
+        self._flushing = None
+
+    def __len__(self):
+        return len(self._items) + self._in_flight
+
+    def put(self, instance_id: str, usage_data: schema.UsageCreate):
+        # samples being written still hold memory, they count towards the limit
+        if len(self) >= self.max_size:
+            raise BufferFull()
+        self._items.append((instance_id, usage_data))
+        if len(self._items) >= self.flush_rows:
+            self._flush_requested.set()
+
+    def start(self):
+        self._flush_requested = asyncio.Event()
+        self._flushing = asyncio.Lock()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        self._flush_requested.set()
+        await self._task
+
+    async def _run(self):
+        while not self._stopping:
+            try:
+                await asyncio.wait_for(self._flush_requested.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_requested.clear()
+            await self.flush()
+        # whatever came in during the last flush
+        await self.flush()
+
+    async def flush(self):
+        # one flush at a time, a flush returns after the samples queued before
+        # it was called are written, e.g. before a finished container is costed
+        async with self._flushing:
+            await self._flush()
+
+    async def _flush(self):
+        items, self._items = self._items, []
+        if not items:
+            return
+        self._in_flight = len(items)
+
+        batches = defaultdict(list)
+        for instance_id, usage_data in items:
+            batches[instance_id].append(usage_data)
+        failed = []
+        for instance_id, usage_schemas in batches.items():
+            try:
+                if database.AsyncSessionLocal is not None:
+                    await write_usages_async(instance_id, usage_schemas)
+                else:
+                    await run_in_threadpool(write_usages, instance_id, usage_schemas)
+            except Exception:
+                logger.exception("Writing %d usage samples of instance %s failed", len(usage_schemas), instance_id)
+                failed += [(instance_id, usage_data) for usage_data in usage_schemas]
+            self._in_flight -= len(usage_schemas)
+        if failed:
+            self.requeue(failed)
+
+    def requeue(self, items: list):
+        # failed samples go back to the front of the queue and are written
+        # with the next flush, while the database is down the buffer fills
+        # up and ingest answers 503
+        room = max(self.max_size - len(self), 0)
+        if len(items) > room:
+            logger.error("Buffer is full, dropped %d usage samples", len(items) - room)
+        self._items[:0] = items[:room]
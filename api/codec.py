@@ -0,0 +1,133 @@
+import zlib
+
+import msgpack
+from pydantic import TypeAdapter, ValidationError
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MSGPACK_CONTENT_TYPES = ("application/msgpack", "application/x-msgpack")
+
+# decompressed bodies larger than this are rejected
+MAX_BODY_SIZE = 64 * 1024 * 1024
+
+# Compact batch layout, app and container names are sent once per batch and
+# samples refer to containers by their position in the table:
+#
+#   {
+#     "apps": ["application_1697720075274_7464", ...],
+#     "containers": [["container_1697720075274_7464_01_000036", 0], ...],
+#     "samples": [[pid, container, start, process_time, cpu_time, cpu_usage, time], ...]
+#   }
+Sample = tuple[int, int, float, float, float, float, int]
+SAMPLE = TypeAdapter(Sample)
+SAMPLES = TypeAdapter(list[Sample])
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+class UnsupportedEncoding(Exception):
+    pass
+
+
+def decode_body(body: bytes, content_encoding: str | None) -> bytes:
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        return body
+    if encoding in ("gzip", "x-gzip"):
+        return decompress_gzip(body)
+    if encoding == "zstd":
+        if zstandard is None:
+            raise UnsupportedEncoding("zstd support is not installed.")
+        return decompress_zstd(body)
+    raise UnsupportedEncoding(f"Unsupported content encoding {encoding}.")
+
+def decompress_gzip(body: bytes) -> bytes:
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        data = decompressor.decompress(body, MAX_BODY_SIZE + 1)
+    except zlib.error as e:
+        raise ValueError(str(e))
+    if len(data) > MAX_BODY_SIZE:
+        raise BodyTooLarge()
+    return data
+
+def decompress_zstd(body: bytes) -> bytes:
+    try:
+        with zstandard.ZstdDecompressor().stream_reader(body) as reader:
+            data = reader.read(MAX_BODY_SIZE + 1)
+    except zstandard.ZstdError as e:
+        raise ValueError(str(e))
+    if len(data) > MAX_BODY_SIZE:
+        raise BodyTooLarge()
+    return data
+
+def unpack_usage_batch(body: bytes):
+    batch = msgpack.unpackb(body, use_list=False, max_bin_len=0, max_ext_len=0)
+    if not isinstance(batch, dict):
+        raise ValueError("Expected a map with apps, containers and samples.")
+    apps = batch.get("apps", ())
+    containers = []
+    for name, app in batch.get("containers", ()):
+        if not isinstance(app, int) or not 0 <= app < len(apps):
+            raise ValueError(f"Unknown app {app}.")
+        if not isinstance(name, str) or not isinstance(apps[app], str):
+            raise ValueError("App and container names must be strings.")
+        containers.append((apps[app], name))
+
+    # the whole sample table is validated in one call, rows are only
+    # validated one by one to report errors when some of them are invalid
+    samples = batch.get("samples", ())
+    errors = {}
+    try:
+        samples = SAMPLES.validate_python(samples)
+    except ValidationError:
+        samples = [validate_sample(sample, i, errors) for i, sample in enumerate(samples)]
+
+    results = []
+    valid = []
+    for i, sample in enumerate(samples):
+        if i in errors:
+            results.append({"status": "invalid", "errors": errors[i]})
+            continue
+        pid, container, start, process_time, cpu_time, cpu_usage, time = sample
+        if not 0 <= container < len(containers):
+            results.append({"status": "invalid", "errors": [{"msg": f"Unknown container {container}."}]})
+            continue
+        app, name = containers[container]
+        results.append({"status": "created"})
+        valid.append((len(results) - 1, {
+            "pid": pid,
+            "app": app,
+            "container": name,
+            "start": start,
+            "process_time": process_time,
+            "cpu_time": cpu_time,
+            "cpu_usage": cpu_usage,
+            "time": time,
+        }))
+    return results, valid
+
+def validate_sample(sample, i: int, errors: dict):
+    try:
+        return SAMPLE.validate_python(sample)
+    except ValidationError as e:
+        errors[i] = e.errors(include_url=False, include_context=False)
+
+def pack_usage_batch(usages: list[dict]) -> bytes:
+    apps = {}
+    containers = {}
+    samples = []
+    for u in usages:
+        app = apps.setdefault(u["app"], len(apps))
+        container = containers.setdefault(u["container"], (len(containers), app))[0]
+        samples.append((u["pid"], container, u["start"], u["process_time"], u["cpu_time"], u["cpu_usage"], u["time"]))
+    return msgpack.packb({
+        "apps": list(apps),
+        "containers": [(name, app) for name, (_, app) in containers.items()],
+        "samples": samples,
+    })
@@ -1,22 +1,139 @@
 import os
 import json
-from pkg_resources import resource_filename
 
-def get_postgres_uri():
-    host = os.environ.get("DB_HOST")
-    port = os.environ.get("DB_PORT")
+from enums import CostEngine
+
+def get_postgres_uri(driver="postgresql", host=None, port=None):
+    host = host or os.environ.get("DB_HOST")
+    port = port or os.environ.get("DB_PORT")
     password = os.environ.get("DB_PASSWORD")
     user = os.environ.get("DB_USER")
     db_name = os.environ.get("DB_NAME")
-    return f"postgresql://{user}:{password}@{host}:{port}/{db_name}"
+    return f"{driver}://{user}:{password}@{host}:{port}/{db_name}"
+
+def get_async_postgres_uri():
+    return get_postgres_uri(driver="postgresql+asyncpg")
+
+def get_read_postgres_uri():
+    # read only views go to a replica when one is configured
+    host = os.environ.get("DB_READ_HOST")
+    if not host:
+        return ""
+    return get_postgres_uri(host=host, port=os.environ.get("DB_READ_PORT"))
+
+def get_flag(name):
+    return os.environ.get(name, "").lower() in ("1", "true")
+
+def get_db_async():
+    return get_flag("DB_ASYNC")
+
+def get_db_pool_size():
+    return int(os.environ.get("DB_POOL_SIZE", "5"))
+
+def get_db_max_overflow():
+    return int(os.environ.get("DB_MAX_OVERFLOW", "10"))
+
+def get_db_pool_timeout():
+    return float(os.environ.get("DB_POOL_TIMEOUT", "30"))
+
+def get_db_pool_recycle():
+    return int(os.environ.get("DB_POOL_RECYCLE", "-1"))
+
+def get_db_pool_pre_ping():
+    return get_flag("DB_POOL_PRE_PING")
+
+def get_db_pgbouncer():
+    return get_flag("DB_PGBOUNCER")
 
 
 def get_secret_api_key():
     return os.environ.get("SECRET_API_KEY", "")
 
 def load_region_map():
-    endpoint_file = resource_filename("botocore", "data/endpoints.json")
+    # imported here, botocore is only needed by processes that call AWS
+    import botocore
+
+    endpoint_file = os.path.join(os.path.dirname(botocore.__file__), "data", "endpoints.json")
     with open(endpoint_file, "r") as f:
         endpoint_data = json.load(f)
 
     return endpoint_data["partitions"][0]["regions"]
+
+def get_identity_cache_size():
+    return int(os.environ.get("IDENTITY_CACHE_SIZE", "10000"))
+
+def get_identity_cache_ttl():
+    return float(os.environ.get("IDENTITY_CACHE_TTL", "300"))
+
+def get_usage_buffer_enabled():
+    return get_flag("USAGE_BUFFER_ENABLED")
+
+def get_usage_buffer_max_size():
+    return int(os.environ.get("USAGE_BUFFER_MAX_SIZE", "100000"))
+
+def get_usage_buffer_flush_interval():
+    return int(os.environ.get("USAGE_BUFFER_FLUSH_INTERVAL_MS", "500")) / 1000
+
+def get_usage_buffer_flush_rows():
+    return int(os.environ.get("USAGE_BUFFER_FLUSH_ROWS", "5000"))
+
+def get_usage_partitioning():
+    return get_flag("USAGE_PARTITIONING")
+
+def get_usage_partition_days_ahead():
+    return int(os.environ.get("USAGE_PARTITION_DAYS_AHEAD", "7"))
+
+def get_usage_retention_days():
+    return int(os.environ.get("USAGE_RETENTION_DAYS", "0"))
+
+def get_usage_compaction():
+    return get_flag("USAGE_COMPACTION")
+
+def get_usage_compaction_delay():
+    return int(os.environ.get("USAGE_COMPACTION_DELAY", "600"))
+
+def get_usage_bucket_retention_days():
+    return int(os.environ.get("USAGE_BUCKET_RETENTION_DAYS", "0"))
+
+def get_price_cache_url():
+    return os.environ.get("PRICE_CACHE_URL", "")
+
+def get_price_cache_ttl():
+    return int(os.environ.get("PRICE_CACHE_TTL", "86400"))
+
+def get_price_snapshot_path():
+    return os.environ.get("PRICE_SNAPSHOT_PATH", "")
+
+def get_cost_coalesce_seconds():
+    return int(os.environ.get("COST_COALESCE_SECONDS", "0"))
+
+def get_cost_engine():
+    return CostEngine(os.environ.get("COST_ENGINE", CostEngine.AVERAGE.value))
+
+def get_cost_estimate_enabled():
+    return get_flag("COST_ESTIMATE_ENABLED")
+
+def get_cost_estimate_url():
+    return os.environ.get("COST_ESTIMATE_URL", "")
+
+def get_cost_estimate_flush_interval():
+    return int(os.environ.get("COST_ESTIMATE_FLUSH_INTERVAL_MS", "5000")) / 1000
+
+def get_cost_estimate_ttl():
+    return int(os.environ.get("COST_ESTIMATE_TTL", str(7 * 24 * 3600)))
+
+def get_cost_estimate_max_applications():
+    # applications kept in memory when there is no COST_ESTIMATE_URL
+    return int(os.environ.get("COST_ESTIMATE_MAX_APPLICATIONS", "1000"))
+
+def get_metrics_port():
+    return int(os.environ.get("METRICS_PORT", "9100"))
+
+def get_response_cache_url():
+    return os.environ.get("RESPONSE_CACHE_URL", "")
+
+def get_response_cache_size():
+    return int(os.environ.get("RESPONSE_CACHE_SIZE", "1000"))
+
+def get_response_cache_ttl():
+    return int(os.environ.get("RESPONSE_CACHE_TTL", "3600"))
@@ -0,0 +1,21 @@
+from datetime import datetime
+
+# Cost of a container from the summary of its usage, shared by the worker
+# and the running estimates of the api.
+
+
+def calculate_cost(price, elapsed_hours, avg_cpu_usage_percent):
+    return price * elapsed_hours * avg_cpu_usage_percent / 100
+
+
+def get_elapsed_hours(first_ts, last_ts):
+    first_dt = datetime.fromtimestamp(first_ts)
+    last_dt = datetime.fromtimestamp(last_ts)
+    elapsed_td = last_dt - first_dt
+    return elapsed_td.days * 24 + elapsed_td.seconds / 3600
+
+
+def calculate_on_demand_cost(summary, price):
+    elapsed_hours = get_elapsed_hours(summary.first_time, summary.last_time)
+    average_cpu_usage = summary.cpu_usage_sum / summary.sample_count
+    return calculate_cost(price, elapsed_hours, average_cpu_usage)
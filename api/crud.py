@@ -1,10 +1,20 @@
-from sqlalchemy import select 
-from sqlalchemy.orm import Session
+from collections import namedtuple
+
+from sqlalchemy import DateTime, Integer, Select, String, column, delete, event, exists, false, insert, literal, literal_column, select, true, tuple_, union_all, update, values
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.orm import Session, aliased, joinedload
 from sqlalchemy.sql import func
-from model import Usage, Container, Application, Instance, ContainerCost
+from model import Usage, Container, Application, ApplicationSummary, Instance, ContainerCost, UsageSummary, UsageBucket
+import cache
 import schema
 from datetime import datetime
 
+USAGE_BUCKET_RESOLUTION = 60
+# compacted containers keep only the buckets, minute buckets may expire later
+USAGE_BUCKET_RESOLUTIONS = (USAGE_BUCKET_RESOLUTION, 3600)
+
+UsagePoint = namedtuple("UsagePoint", ["time", "cpu_usage"])
+
 def get_application_by_name(session: Session, name: str):
     stmt = select(Application).where(Application.name == name)
     app = session.scalar(stmt)
@@ -18,99 +28,595 @@ def get_application_cost_by_name(session: Session, name: str):
             .group_by(Application.id))
     return session.scalar(stmt)
 
+def get_application_with_summary(session: Session, name: str):
+    stmt = (select(Application, ApplicationSummary)
+            .outerjoin(ApplicationSummary, ApplicationSummary.application_id == Application.id)
+            .where(Application.name == name))
+    return session.execute(stmt).first()
+
+def list_application_containers(session: Session, application_id: int, limit: int, after: int | None = None):
+    stmt = (select(Container)
+            .where(Container.application_id == application_id)
+            .options(joinedload(Container.instance), joinedload(Container.cost)))
+    if after is not None:
+        stmt = stmt.where(Container.id > after)
+    stmt = stmt.order_by(Container.id).limit(limit)
+    return list(session.scalars(stmt))
+
 def get_container_by_name(session: Session, name: str):
     stmt = select(Container).where(Container.name == name)
     container = session.scalar(stmt)
     return container
 
+def get_costed_container_names(session: Session, application_id: int, names: list[str]):
+    stmt = (select(Container.name)
+            .join(ContainerCost, Container.cost)
+            .where((Container.application_id == application_id) & Container.name.in_(names)))
+    return set(session.scalars(stmt))
+
+def get_application_ids(session: Session, start: datetime | None = None, end: datetime | None = None, names: list[str] | None = None):
+    stmt = select(Application.id).order_by(Application.id)
+    if start is not None:
+        stmt = stmt.where(Application.start_time >= start)
+    if end is not None:
+        stmt = stmt.where(Application.start_time < end)
+    if names is not None:
+        stmt = stmt.where(Application.name.in_(names))
+    return list(session.scalars(stmt))
+
+def stream_finished_containers(session: Session, application_id: int, chunk_size: int):
+    # server side cursor, yields lists of up to chunk_size containers
+    stmt = (select(Container)
+            .where((Container.application_id == application_id) & Container.finished)
+            .options(joinedload(Container.instance), joinedload(Container.application))
+            .order_by(Container.id)
+            .execution_options(yield_per=chunk_size))
+    for partition in session.execute(stmt).scalars().partitions():
+        yield list(partition)
+
+def get_containers_with_instances(session: Session, names: list[str]):
+    stmt = (select(Container)
+            .where(Container.name.in_(names))
+            .options(joinedload(Container.instance)))
+    return list(session.scalars(stmt))
+
 def get_instance_by_instance_id(session: Session, instance_id: str):
     stmt = select(Instance).where(Instance.instance_id == instance_id)
     instance = session.scalar(stmt)
     return instance
 
+def get_instances_by_ids(session: Session, ids: set[int]):
+    stmt = select(Instance).where(Instance.id.in_(ids))
+    return {instance.id: instance for instance in session.scalars(stmt)}
+
+def get_instances_by_instance_ids(session: Session, instance_ids: set[str]):
+    stmt = select(Instance).where(Instance.instance_id.in_(instance_ids))
+    return {instance.instance_id: instance for instance in session.scalars(stmt)}
+
 def create_instance(session: Session, instance_schema: schema.InstanceCreate):
     instance = Instance(**instance_schema.model_dump())
     session.add(instance)
     return instance
 
-def create_application(session: Session, name: str): 
-    app = Application(name=name)
+def create_application(session: Session, name: str, start_time: datetime):
+    app = Application(name=name, start_time=start_time)
     session.add(app)
     return app
 
-def create_container(session: Session, name: str, instance: Instance, application: Application):
-    container = Container(name=name, instance=instance, application=application)
+def create_container(session: Session, name: str, instance_id: int, application_id: int):
+    container = Container(name=name, instance_id=instance_id, application_id=application_id)
     session.add(container)
     return container
 
-def create_usage(session: Session, instance_id: str, usage_schema: schema.UsageCreate):
-    data = usage_schema.model_dump()
-    # retrieve instance if exists
-    instance = get_instance_by_instance_id(session, instance_id)
-    if instance is None:
+def get_instance_id(session: Session, instance_id: str):
+    id_ = cache.instance_ids.get(instance_id)
+    if id_ is None:
+        instance = get_instance_by_instance_id(session, instance_id)
+        if instance is None:
+            return None
+        id_ = instance.id
+        cache.instance_ids.set(instance_id, id_)
+    return id_
+
+def upsert_containers(session: Session, instance_pk: int, containers: dict[str, str], apps: dict[str, datetime]):
+    # One statement creates the missing applications, their summaries and the
+    # containers, so executors of a new application reporting at once don't
+    # race on the unique names. Rows that exist are read without locking them,
+    # only names missing from the statement's snapshot are inserted. DO UPDATE
+    # instead of DO NOTHING returns the ids of rows inserted concurrently, which
+    # the snapshot can't see, and xmax is 0 only for rows this statement inserted.
+    # Rows are written in name and id order to lock them in the same order.
+    # Column defaults aren't applied to inserts in a CTE, they are given here.
+    app_rows = values(column("name", String), column("start_time", DateTime), name="app_rows").data(sorted(apps.items()))
+    app_insert = pg_insert(Application).from_select(
+        ["name", "start_time", "finished"],
+        select(app_rows.c.name, app_rows.c.start_time, false())
+        .where(~exists().where(Application.name == app_rows.c.name))
+        .order_by(app_rows.c.name),
+    )
+    app_upsert = (app_insert
+                  .on_conflict_do_update(index_elements=[Application.name], set_={"name": app_insert.excluded.name})
+                  .returning(Application.id, Application.name, Application.start_time, (literal_column("xmax") == 0).label("inserted"))
+                  .cte("app_upsert"))
+    app_ids = union_all(
+        select(Application.id, Application.name, Application.start_time, false().label("inserted"))
+        .where(Application.name.in_(list(apps))),
+        select(app_upsert),
+    ).cte("apps")
+
+    container_rows = values(column("name", String), column("app_name", String), name="container_rows").data(sorted(containers.items()))
+    container_insert = pg_insert(Container).from_select(
+        ["name", "instance_id", "application_id", "finished"],
+        select(container_rows.c.name, literal(instance_pk), app_ids.c.id, false())
+        .select_from(container_rows.join(app_ids, app_ids.c.name == container_rows.c.app_name))
+        .where(~exists().where(Container.name == container_rows.c.name))
+        .order_by(container_rows.c.name),
+    )
+    container_upsert = (container_insert
+                        .on_conflict_do_update(index_elements=[Container.name], set_={"name": container_insert.excluded.name})
+                        .returning(Container.id, Container.name, Container.application_id, (literal_column("xmax") == 0).label("inserted"))
+                        .cte("container_upsert"))
+    container_ids = union_all(
+        select(Container.id, Container.name, Container.application_id, false().label("inserted"))
+        .where(Container.name.in_(list(containers))),
+        select(container_upsert),
+    ).cte("containers")
+
+    created = (select(container_ids.c.application_id, func.count().label("count"))
+               .where(container_ids.c.inserted)
+               .group_by(container_ids.c.application_id)
+               .cte("created"))
+    # an upsert too, an UPDATE wouldn't see summaries committed after the
+    # statement started
+    summary_insert = pg_insert(ApplicationSummary).from_select(
+        ["application_id", "start_time", "container_count", "finished", "total_cost", "finished_count", "costed_count", "version"],
+        select(app_ids.c.id, app_ids.c.start_time, func.coalesce(created.c.count, 0), false(), literal(0.0), literal(0), literal(0), literal(0))
+        .select_from(app_ids.outerjoin(created, created.c.application_id == app_ids.c.id))
+        .where(app_ids.c.inserted | (created.c.count > 0))
+        .order_by(app_ids.c.id),
+    )
+    summaries = (summary_insert
+                 .on_conflict_do_update(index_elements=[ApplicationSummary.application_id], set_={
+                     "container_count": ApplicationSummary.container_count + summary_insert.excluded.container_count,
+                     "version": ApplicationSummary.version + 1,
+                 })
+                 .cte("summaries"))
+
+    stmt = select(container_ids.c.name, container_ids.c.id, container_ids.c.inserted).add_cte(summaries)
+    return session.execute(stmt).all()
+
+# containers seen before only cost a cache lookup, the rest are created
+# together with their applications or read in the same statement
+def get_or_create_container_ids(session: Session, instance_id: str, containers: dict[str, tuple[str, datetime]]):
+    ids = {}
+    for name in containers:
+        id_ = cache.container_ids.get(name)
+        if id_ is not None:
+            ids[name] = id_
+    missing = set(containers) - set(ids)
+    if not missing:
+        return ids
+
+    instance_pk = get_instance_id(session, instance_id)
+    if instance_pk is None:
         # TODO: custom exception
         raise Exception("Instance not found")
 
-    app_name = data.pop("app")
-    app = get_application_by_name(session, app_name)
-    if app is None:
-        app = create_application(session, app_name)
-    else:
-        session.add(app)
+    apps = {}
+    for name in missing:
+        app_name, start = containers[name]
+        apps[app_name] = min(start, apps.get(app_name, start))
+    for name, id_, inserted in upsert_containers(session, instance_pk, {name: containers[name][0] for name in missing}, apps):
+        if inserted:
+            # cached once committed, a rolled back container doesn't exist
+            session.info.setdefault("created_container_ids", {})[name] = id_
+        else:
+            cache.container_ids.set(name, id_)
+        ids[name] = id_
+    return ids
 
-    container_name = data.pop("container")
-    container = get_container_by_name(session, container_name)
-    if container is None:
-        container = create_container(session, container_name, instance, app)
-    session.add(container)
+@event.listens_for(Session, "after_commit")
+def cache_created_container_ids(session: Session):
+    for name, id_ in session.info.pop("created_container_ids", {}).items():
+        cache.container_ids.set(name, id_)
+
+@event.listens_for(Session, "after_rollback")
+def forget_created_container_ids(session: Session):
+    session.info.pop("created_container_ids", None)
 
+def create_usage(session: Session, instance_id: str, usage_schema: schema.UsageCreate):
+    data = usage_schema.model_dump()
+    app_name = data.pop("app")
+    container_name = data.pop("container")
     data["start"] = datetime.utcfromtimestamp(data.pop("start"))
-    usage = Usage(container=container, **data)
-    app.start_time = data["start"]
+
+    container_ids = get_or_create_container_ids(session, instance_id, {container_name: (app_name, data["start"])})
+    usage = Usage(container_id=container_ids[container_name], **data)
     session.add(usage)
+    update_usage_rollups(session, [{"container_id": usage.container_id, **data}])
     return usage
 
+def create_usages(session: Session, instance_id: str, usage_schemas: list[schema.UsageCreate]):
+    return create_usage_records(session, instance_id, [usage_schema.model_dump() for usage_schema in usage_schemas])
+
+# records are dicts with the fields of schema.UsageCreate, they are modified in place
+def create_usage_records(session: Session, instance_id: str, records: list[dict]):
+    if not records:
+        return []
+
+    containers = {}
+    for data in records:
+        data["start"] = datetime.utcfromtimestamp(data.pop("start"))
+        containers.setdefault(data["container"], (data["app"], data["start"]))
+    container_ids = get_or_create_container_ids(session, instance_id, containers)
+
+    for data in records:
+        data.pop("app")
+        data["container_id"] = container_ids[data.pop("container")]
+
+    stmt = insert(Usage).returning(Usage.id, sort_by_parameter_order=True)
+    ids = list(session.scalars(stmt, records))
+    update_usage_rollups(session, records)
+    return ids
+
+def update_usage_rollups(session: Session, records: list[dict]):
+    summaries = {}
+    buckets = {}
+    for data in records:
+        container_id = data["container_id"]
+        summary = summaries.get(container_id)
+        if summary is None:
+            summaries[container_id] = {
+                "container_id": container_id,
+                "sample_count": 1,
+                "cpu_usage_sum": data["cpu_usage"],
+                "first_time": data["time"],
+                "last_time": data["time"],
+            }
+        else:
+            summary["sample_count"] += 1
+            summary["cpu_usage_sum"] += data["cpu_usage"]
+            summary["first_time"] = min(summary["first_time"], data["time"])
+            summary["last_time"] = max(summary["last_time"], data["time"])
+
+        bucket_time = data["time"] - data["time"] % USAGE_BUCKET_RESOLUTION
+        bucket = buckets.get((container_id, bucket_time))
+        if bucket is None:
+            buckets[(container_id, bucket_time)] = {
+                "container_id": container_id,
+                "resolution": USAGE_BUCKET_RESOLUTION,
+                "time": bucket_time,
+                "sample_count": 1,
+                "cpu_usage_sum": data["cpu_usage"],
+            }
+        else:
+            bucket["sample_count"] += 1
+            bucket["cpu_usage_sum"] += data["cpu_usage"]
+
+    # rows are upserted in primary key order so that concurrent batches
+    # lock them in the same order
+    stmt = pg_insert(UsageSummary).values(sorted(summaries.values(), key=lambda row: row["container_id"]))
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UsageSummary.container_id],
+        set_={
+            "sample_count": UsageSummary.sample_count + stmt.excluded.sample_count,
+            "cpu_usage_sum": UsageSummary.cpu_usage_sum + stmt.excluded.cpu_usage_sum,
+            "first_time": func.least(UsageSummary.first_time, stmt.excluded.first_time),
+            "last_time": func.greatest(UsageSummary.last_time, stmt.excluded.last_time),
+        },
+    )
+    session.execute(stmt)
+
+    stmt = pg_insert(UsageBucket).values([buckets[key] for key in sorted(buckets)])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[UsageBucket.container_id, UsageBucket.resolution, UsageBucket.time],
+        set_={
+            "sample_count": UsageBucket.sample_count + stmt.excluded.sample_count,
+            "cpu_usage_sum": UsageBucket.cpu_usage_sum + stmt.excluded.cpu_usage_sum,
+        },
+    )
+    session.execute(stmt)
+
 def mark_container_finished(session: Session, container_name: str):
     container = get_container_by_name(session, container_name)
     if container is None:
         print(container_name)
         # TODO: custom excetpion
         raise Exception("Container not found.")
-    container.finished = True
-    session.add(container)
+    # only the statement that flips the flag counts the container, a
+    # concurrent finish waits for it and then finds the container finished
+    stmt = (update(Container)
+            .where((Container.id == container.id) & ~Container.finished)
+            .values(finished=True)
+            .returning(Container.id))
+    if session.execute(stmt).first() is not None:
+        update_application_summary(session, container.application_id, finished_count=ApplicationSummary.finished_count + 1)
+    cache.container_ids.invalidate(container.name)
     return container
 
-def get_container_first_usage(session: Session, container: Container):
-    stmt = select(Usage).where(Usage.container_id == container.id).order_by(Usage.time.asc()).limit(1)
-    usage = session.scalars(stmt)
-    if not usage:
+def get_container_usage_summary(session: Session, container: Container):
+    summary = session.get(UsageSummary, container.id)
+    if summary is not None:
+        return summary
+    # containers ingested before the rollups existed
+    stmt = select(
+        func.count(Usage.id).label("sample_count"),
+        func.sum(Usage.cpu_usage).label("cpu_usage_sum"),
+        func.min(Usage.time).label("first_time"),
+        func.max(Usage.time).label("last_time"),
+    ).where(Usage.container_id == container.id)
+    summary = session.execute(stmt).one()
+    if summary.sample_count == 0:
         raise Exception("Usage not found")
-    return usage.one()
+    return summary
 
-def get_container_last_usage(session: Session, container: Container):
-    stmt = select(Usage).where(Container.id == container.id).order_by(Usage.time.desc()).limit(1)
-    usage = session.scalars(stmt)
-    if not usage:
-        raise Exception("Usage not found")
-    return usage.one()
+def get_containers_usage_summaries(session: Session, container_ids: list[int]):
+    stmt = select(UsageSummary).where(UsageSummary.container_id.in_(container_ids))
+    summaries = {summary.container_id: summary for summary in session.scalars(stmt)}
+    missing = set(container_ids) - set(summaries)
+    if missing:
+        # containers ingested before the rollups existed
+        stmt = (select(
+                    Usage.container_id,
+                    func.count(Usage.id).label("sample_count"),
+                    func.sum(Usage.cpu_usage).label("cpu_usage_sum"),
+                    func.min(Usage.time).label("first_time"),
+                    func.max(Usage.time).label("last_time"))
+                .where(Usage.container_id.in_(missing))
+                .group_by(Usage.container_id))
+        summaries.update({row.container_id: row for row in session.execute(stmt)})
+    return summaries
+
+def get_containers_cpu_usage_series(session: Session, container_ids: list[int]):
+    # raw samples of compacted containers don't cover their summary, e.g.
+    # when late samples arrived after the compaction, their series is read
+    # from the rollups, which also hold the late samples
+    raw_count = select(func.count(Usage.id)).where(Usage.container_id == UsageSummary.container_id).scalar_subquery()
+    stmt = (select(UsageSummary.container_id)
+            .where(UsageSummary.container_id.in_(container_ids) & (UsageSummary.sample_count > raw_count)))
+    compacted = set(session.scalars(stmt))
+
+    series = {container_id: [] for container_id in container_ids}
+    raw_ids = [container_id for container_id in container_ids if container_id not in compacted]
+    if raw_ids:
+        stmt = (select(Usage.container_id, Usage.time, Usage.cpu_usage)
+                .where(Usage.container_id.in_(raw_ids))
+                .order_by(Usage.container_id, Usage.time.asc()))
+        for row in session.execute(stmt):
+            series[row.container_id].append(row)
+    if compacted:
+        series.update(get_containers_bucket_series(session, sorted(compacted)))
+    return series
+
+def get_containers_bucket_series(session: Session, container_ids: list[int]):
+    stmt = (select(
+                UsageBucket.container_id,
+                UsageBucket.resolution,
+                UsageBucket.time,
+                (UsageBucket.cpu_usage_sum / UsageBucket.sample_count).label("cpu_usage"),
+                UsageSummary.first_time,
+                UsageSummary.last_time)
+            .join(UsageSummary, UsageSummary.container_id == UsageBucket.container_id)
+            .where(UsageBucket.container_id.in_(container_ids))
+            .order_by(UsageBucket.container_id, UsageBucket.resolution, UsageBucket.time.asc()))
+    series = {}
+    for row in session.execute(stmt):
+        points = series.get(row.container_id)
+        if points is None:
+            # a sample holds the usage since the previous one, the bucket
+            # average is placed at the end of the bucket
+            points = series[row.container_id] = [UsagePoint(row.first_time, 0.0)]
+            resolution = row.resolution
+        elif row.resolution != resolution:
+            # only the finest resolution is used
+            continue
+        end = min(max(row.time + row.resolution, row.first_time), row.last_time)
+        points.append(UsagePoint(end, row.cpu_usage))
+    return series
 
-def get_container_average_cpu_usage(session: Session, container: Container):
-    stmt = select(func.avg(Usage.cpu_usage)).where(Usage.container_id == container.id)
-    average_usage = session.scalar(stmt)
-    return average_usage
+def get_container_cpu_usage_series(session: Session, container: Container):
+    return get_containers_cpu_usage_series(session, [container.id])[container.id]
+
+def container_ids_query(**filters):
+    # ids of the containers matching the column filters, used as a subquery
+    return select(Container.id).filter_by(**filters)
+
+def get_usage_time_range(session: Session, container_ids: Select):
+    stmt = (select(func.min(UsageSummary.first_time), func.max(UsageSummary.last_time))
+            .where(UsageSummary.container_id.in_(container_ids)))
+    return session.execute(stmt).one()
+
+def get_usage_series(session: Session, container_ids: Select, resolution: int, start: int, end: int):
+    # cpu usage of the containers summed per instance and bucket of resolution
+    # seconds, with the cpu seconds used in the bucket for pricing. Times are
+    # epoch seconds, a bucket starts at time - time % resolution.
+    if resolution < USAGE_BUCKET_RESOLUTION or resolution % USAGE_BUCKET_RESOLUTION:
+        # the rollups only add up to buckets of whole minutes
+        source = (select(Usage.container_id, Usage.time, Usage.cpu_usage.label("cpu_usage_sum"), literal(1).label("sample_count"))
+                  .where(Usage.container_id.in_(container_ids)))
+    else:
+        # the coarsest rollup that divides the buckets, compacted containers
+        # may only have hourly ones left
+        containers = container_ids.subquery()
+        rollup = (select(UsageBucket.resolution)
+                  .where((UsageBucket.container_id == containers.c.id) &
+                         (UsageBucket.resolution <= resolution) &
+                         (literal(resolution) % UsageBucket.resolution == 0))
+                  .order_by(UsageBucket.resolution.desc())
+                  .limit(1)
+                  .lateral("rollup"))
+        rollups = (select(containers.c.id.label("container_id"), rollup.c.resolution)
+                   .select_from(containers)
+                   .join(rollup, true())
+                   .subquery())
+        source = (select(UsageBucket.container_id, UsageBucket.time, UsageBucket.cpu_usage_sum, UsageBucket.sample_count)
+                  .join(rollups, (rollups.c.container_id == UsageBucket.container_id) & (rollups.c.resolution == UsageBucket.resolution)))
+    source = source.subquery()
+    bucket = source.c.time - source.c.time % resolution
+    buckets = (select(
+                   source.c.container_id,
+                   bucket.label("time"),
+                   (func.sum(source.c.cpu_usage_sum) / func.sum(source.c.sample_count)).label("cpu_usage"))
+               .where((source.c.time >= start - start % resolution) & (source.c.time < end))
+               .group_by(source.c.container_id, bucket)
+               .subquery())
 
-def get_container_average_cpu_usage_for_time_range(session: Session, container: Container, start: float, end: float):
-    stmt = select(func.avg(Usage.cpu_usage)).where(
-        (Usage.container_id == container.id) &
-        (Usage.time > start) &
-        (Usage.time < end))
-    average_usage = session.scalar(stmt)
-    return average_usage
+    # containers running for only a part of the bucket use cpu for that part
+    seconds = func.greatest(
+        func.least(buckets.c.time + resolution, UsageSummary.last_time) - func.greatest(buckets.c.time, UsageSummary.first_time), 0)
+    stmt = (select(
+                Container.instance_id,
+                buckets.c.time,
+                func.sum(buckets.c.cpu_usage).label("cpu_usage"),
+                func.sum(buckets.c.cpu_usage / 100 * seconds).label("cpu_seconds"))
+            .select_from(buckets)
+            .join(Container, Container.id == buckets.c.container_id)
+            .join(UsageSummary, UsageSummary.container_id == buckets.c.container_id)
+            .group_by(Container.instance_id, buckets.c.time)
+            .order_by(buckets.c.time))
+    return session.execute(stmt).all()
+
+def get_usage_counters(session: Session, points: list[tuple[int, int]]):
+    # cumulative cpu counters of containers at the given times, interpolated
+    # between the samples around each time, two index lookups per point
+    if not points:
+        return {}
+    points = values(column("container_id", Integer), column("time", Integer), name="points").data(points)
+    before = (select(Usage.time, Usage.process_time, Usage.cpu_time)
+              .where((Usage.container_id == points.c.container_id) & (Usage.time <= points.c.time))
+              .order_by(Usage.time.desc())
+              .limit(1)
+              .lateral("before"))
+    after = (select(Usage.time, Usage.process_time, Usage.cpu_time)
+             .where((Usage.container_id == points.c.container_id) & (Usage.time >= points.c.time))
+             .order_by(Usage.time.asc())
+             .limit(1)
+             .lateral("after"))
+    stmt = (select(
+                points.c.container_id,
+                points.c.time,
+                before.c.time.label("before_time"),
+                before.c.process_time.label("before_process_time"),
+                before.c.cpu_time.label("before_cpu_time"),
+                after.c.time.label("after_time"),
+                after.c.process_time.label("after_process_time"),
+                after.c.cpu_time.label("after_cpu_time"))
+            .select_from(points)
+            .join(before, true())
+            .join(after, true()))
+
+    counters = {}
+    for row in session.execute(stmt):
+        if row.after_time == row.before_time:
+            weight = 0.0
+        else:
+            weight = (row.time - row.before_time) / (row.after_time - row.before_time)
+        counters[(row.container_id, row.time)] = (
+            row.time,
+            row.before_process_time + weight * (row.after_process_time - row.before_process_time),
+            row.before_cpu_time + weight * (row.after_cpu_time - row.before_cpu_time),
+        )
+    return counters
+
+def compact_container_usage(session: Session, container_ids: list[int]):
+    # only containers with a final cost are compacted
+    stmt = (select(Container.id)
+            .join(ContainerCost, Container.cost)
+            .where(Container.id.in_(container_ids) & Container.finished)
+            .order_by(Container.id))
+    container_ids = list(session.scalars(stmt))
+    if not container_ids:
+        return 0
+
+    # containers ingested before the rollups existed, rollups written at
+    # ingest are complete and left as they are
+    rows = (select(
+                Usage.container_id,
+                func.count(Usage.id),
+                func.sum(Usage.cpu_usage),
+                func.min(Usage.time),
+                func.max(Usage.time))
+            .where(Usage.container_id.in_(container_ids))
+            .group_by(Usage.container_id))
+    stmt = pg_insert(UsageSummary).from_select(
+        ["container_id", "sample_count", "cpu_usage_sum", "first_time", "last_time"], rows)
+    session.execute(stmt.on_conflict_do_nothing())
+
+    bucket_time = Usage.time - Usage.time % USAGE_BUCKET_RESOLUTION
+    rows = (select(
+                Usage.container_id,
+                literal(USAGE_BUCKET_RESOLUTION),
+                bucket_time,
+                func.count(Usage.id),
+                func.sum(Usage.cpu_usage))
+            .where(Usage.container_id.in_(container_ids))
+            .group_by(Usage.container_id, bucket_time))
+    stmt = pg_insert(UsageBucket).from_select(
+        ["container_id", "resolution", "time", "sample_count", "cpu_usage_sum"], rows)
+    session.execute(stmt.on_conflict_do_nothing())
+
+    for resolution, source in zip(USAGE_BUCKET_RESOLUTIONS[1:], USAGE_BUCKET_RESOLUTIONS):
+        bucket_time = UsageBucket.time - UsageBucket.time % resolution
+        rows = (select(
+                    UsageBucket.container_id,
+                    literal(resolution),
+                    bucket_time,
+                    func.sum(UsageBucket.sample_count),
+                    func.sum(UsageBucket.cpu_usage_sum))
+                .where(UsageBucket.container_id.in_(container_ids) & (UsageBucket.resolution == source))
+                .group_by(UsageBucket.container_id, bucket_time))
+        stmt = pg_insert(UsageBucket).from_select(
+            ["container_id", "resolution", "time", "sample_count", "cpu_usage_sum"], rows)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[UsageBucket.container_id, UsageBucket.resolution, UsageBucket.time],
+            set_={"sample_count": stmt.excluded.sample_count, "cpu_usage_sum": stmt.excluded.cpu_usage_sum},
+        )
+        session.execute(stmt)
+
+    stmt = delete(Usage).where(Usage.container_id.in_(container_ids))
+    return session.execute(stmt).rowcount
+
+def delete_expired_usage_buckets(session: Session, before: int):
+    # minute buckets are dropped only where the coarser buckets exist
+    coarse = aliased(UsageBucket)
+    stmt = delete(UsageBucket).where(
+        (UsageBucket.resolution == USAGE_BUCKET_RESOLUTION) &
+        (UsageBucket.time < before) &
+        exists().where(
+            (coarse.container_id == UsageBucket.container_id) &
+            (coarse.resolution == USAGE_BUCKET_RESOLUTIONS[-1])))
+    return session.execute(stmt).rowcount
 
 def create_container_cost(session: Session, container: Container, amount: int):
-    cost = ContainerCost(amount=amount, container_id=container.id)
-    session.add(cost)
-    return cost
+    # a repeated finish or a retried task costs the container again
+    create_container_costs(session, container.application_id, {container.id: amount})
+
+def create_container_costs(session: Session, application_id: int, amounts: dict[int, float]):
+    if not amounts:
+        return
+    # recalculated costs replace the previous amount in the summary. The
+    # summary row is locked first, a concurrent costing of the same
+    # containers then reads the amounts committed by the other one.
+    stmt = select(ApplicationSummary.application_id).where(ApplicationSummary.application_id == application_id).with_for_update()
+    session.execute(stmt)
+    stmt = select(ContainerCost.container_id, ContainerCost.amount).where(ContainerCost.container_id.in_(amounts))
+    previous = dict(session.execute(stmt).all())
+    update_application_summary(
+        session,
+        application_id,
+        total_cost=ApplicationSummary.total_cost + sum(amounts.values()) - sum(previous.values()),
+        costed_count=ApplicationSummary.costed_count + len(set(amounts) - set(previous)),
+    )
+
+    stmt = pg_insert(ContainerCost).values([
+        {"container_id": container_id, "amount": amount}
+        for container_id, amount in sorted(amounts.items())
+    ])
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ContainerCost.container_id],
+        set_={"amount": stmt.excluded.amount},
+    )
+    session.execute(stmt)
 
 def maybe_mark_application_finished(session: Session, application_id: int):
     stmt = select(func.bool_and(Container.finished)).where(Container.application_id == application_id)
@@ -124,23 +630,88 @@ def maybe_mark_application_finished(session: Session, application_id: int):
         raise Exception("Application not found.")
     app.finished = True
     session.add(app)
+    update_application_summary(session, application_id, finished=True)
     return finished
 
-def list_applications(session: Session):
-    stmt = (select(Application, func.sum(ContainerCost.amount).label("cost"))
-            .join(Container, Application.containers)
-            .join(ContainerCost, Container.cost)
-            .group_by(Application.id)
-            .order_by(Application.start_time.desc()))
-    return session.execute(stmt)
+def update_application_summary(session: Session, application_id: int, **values):
+    stmt = (update(ApplicationSummary)
+            .where(ApplicationSummary.application_id == application_id)
+            .values(version=ApplicationSummary.version + 1, **values))
+    session.execute(stmt)
+
+def remove_duplicate_container_costs(session: Session):
+    # keeps the newest cost of every container, returns the applications
+    # whose summaries counted the removed ones
+    newer = aliased(ContainerCost)
+    stmt = (delete(ContainerCost)
+            .where(exists().where((newer.container_id == ContainerCost.container_id) & (newer.id > ContainerCost.id)))
+            .returning(ContainerCost.container_id))
+    container_ids = set(session.scalars(stmt))
+    if not container_ids:
+        return []
+    stmt = select(Container.application_id).where(Container.id.in_(container_ids)).distinct()
+    return list(session.scalars(stmt))
+
+def rebuild_application_summaries(session: Session, application_ids: list[int] | None = None):
+    costs = (select(
+                Container.application_id,
+                func.count(Container.id).label("container_count"),
+                func.count(Container.id).filter(Container.finished).label("finished_count"),
+                func.count(ContainerCost.id).label("costed_count"),
+                func.coalesce(func.sum(ContainerCost.amount), 0).label("total_cost"))
+             .outerjoin(ContainerCost, Container.cost)
+             .group_by(Container.application_id)
+             .subquery())
+    rows = (select(
+                Application.id,
+                Application.start_time,
+                Application.finish_time,
+                Application.finished,
+                func.coalesce(costs.c.total_cost, 0),
+                func.coalesce(costs.c.container_count, 0),
+                func.coalesce(costs.c.finished_count, 0),
+                func.coalesce(costs.c.costed_count, 0))
+            .outerjoin(costs, costs.c.application_id == Application.id))
+    if application_ids is not None:
+        rows = rows.where(Application.id.in_(application_ids))
+    columns = ["application_id", "start_time", "finish_time", "finished", "total_cost", "container_count", "finished_count", "costed_count"]
+    stmt = pg_insert(ApplicationSummary).from_select(columns, rows)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[ApplicationSummary.application_id],
+        set_={"version": ApplicationSummary.version + 1, **{column: stmt.excluded[column] for column in columns[1:]}},
+    )
+    session.execute(stmt)
+
+def list_applications(
+    session: Session,
+    limit: int,
+    cursor: tuple[datetime, int] | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    finished: bool | None = None,
+):
+    stmt = select(Application, ApplicationSummary).join(ApplicationSummary, ApplicationSummary.application_id == Application.id)
+    if cursor is not None:
+        stmt = stmt.where(tuple_(ApplicationSummary.start_time, ApplicationSummary.application_id) < cursor)
+    if start is not None:
+        stmt = stmt.where(ApplicationSummary.start_time >= start)
+    if end is not None:
+        stmt = stmt.where(ApplicationSummary.start_time < end)
+    if finished is not None:
+        stmt = stmt.where(ApplicationSummary.finished == finished)
+    stmt = (stmt
+            .order_by(ApplicationSummary.start_time.desc(), ApplicationSummary.application_id.desc())
+            .limit(limit))
+    return session.execute(stmt).all()
 
-def maybe_update_application_finish_time(session: Session, container: Container, last_usage: Usage | None = None):
+def maybe_update_application_finish_time(session: Session, container: Container, last_time: int | None = None):
     current_finish_time = container.application.finish_time
-    if last_usage is None:
-        last_usage = get_container_last_usage(session, container)
-    last_usage_datetime = datetime.fromtimestamp(last_usage.time)
+    if last_time is None:
+        last_time = get_container_usage_summary(session, container).last_time
+    last_usage_datetime = datetime.fromtimestamp(last_time)
     if current_finish_time is None or current_finish_time < last_usage_datetime:
         container.application.finish_time = last_usage_datetime
         session.add(container)
+        update_application_summary(session, container.application_id, finish_time=last_usage_datetime)
 
 
@@ -0,0 +1,22 @@
+from sqlalchemy.ext.asyncio import AsyncSession
+
+import crud
+import schema
+
+# The ingestion queries are shared with crud, run_sync executes them on the
+# session's asyncpg connection without blocking the event loop.
+
+async def create_instance(session: AsyncSession, instance_schema: schema.InstanceCreate):
+    return await session.run_sync(crud.create_instance, instance_schema)
+
+async def create_usage(session: AsyncSession, instance_id: str, usage_schema: schema.UsageCreate):
+    return await session.run_sync(crud.create_usage, instance_id, usage_schema)
+
+async def create_usages(session: AsyncSession, instance_id: str, usage_schemas: list[schema.UsageCreate]):
+    return await session.run_sync(crud.create_usages, instance_id, usage_schemas)
+
+async def create_usage_records(session: AsyncSession, instance_id: str, records: list[dict]):
+    return await session.run_sync(crud.create_usage_records, instance_id, records)
+
+async def mark_container_finished(session: AsyncSession, container_name: str):
+    return await session.run_sync(crud.mark_container_finished, container_name)
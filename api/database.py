@@ -1,14 +1,69 @@
-from sqlalchemy import create_engine
+from uuid import uuid4
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 import config
-from model import Base
+import crud
+import metrics
+import partitions
+from model import Base, USAGE_PARTITIONING
 
 postgres_uri = config.get_postgres_uri()
+read_postgres_uri = config.get_read_postgres_uri()
+
+
+def pool_options(poolclass):
+    options = {
+        "pool_pre_ping": config.get_db_pool_pre_ping(),
+        "pool_recycle": config.get_db_pool_recycle(),
+    }
+    if config.get_db_pgbouncer():
+        # PgBouncer keeps the server connections, a second pool in front of it
+        # would only hold on to its client slots
+        return {**options, "poolclass": metrics.InstrumentedNullPool}
+    return {
+        **options,
+        "poolclass": poolclass,
+        "pool_size": config.get_db_pool_size(),
+        "max_overflow": config.get_db_max_overflow(),
+        "pool_timeout": config.get_db_pool_timeout(),
+    }
+
+def async_connect_args():
+    if not config.get_db_pgbouncer():
+        return {}
+    # prepared statements live on a server connection, which PgBouncer in
+    # transaction mode may hand to another client after every transaction
+    return {
+        "statement_cache_size": 0,
+        "prepared_statement_cache_size": 0,
+        "prepared_statement_name_func": lambda: f"__asyncpg_{uuid4()}__",
+    }
 
-engine = create_engine(postgres_uri)
-Base.metadata.create_all(bind=engine)
+
+# creating an engine doesn't connect, the schema is set up by `python manage.py migrate`
+engine = create_engine(postgres_uri, **pool_options(metrics.InstrumentedQueuePool))
+metrics.instrument_engine(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=engine)
 
+# dashboard reads go to their own pool, on a replica if there is one, so they
+# can't take all the connections of the ingest path
+read_engine = create_engine(read_postgres_uri or postgres_uri, **pool_options(metrics.InstrumentedQueuePool))
+metrics.instrument_engine(read_engine)
+ReadSessionLocal = sessionmaker(autocommit=False, autoflush=False, expire_on_commit=False, bind=read_engine)
+
+async_engine = None
+AsyncSessionLocal = None
+if config.get_db_async():
+    async_engine = create_async_engine(
+        config.get_async_postgres_uri(),
+        connect_args=async_connect_args(),
+        **pool_options(metrics.InstrumentedAsyncAdaptedQueuePool),
+    )
+    metrics.instrument_engine(async_engine.sync_engine)
+    AsyncSessionLocal = async_sessionmaker(autoflush=False, expire_on_commit=False, bind=async_engine)
+
 def get_db():
     db = SessionLocal()
     try:
@@ -16,3 +71,54 @@ def get_db():
     finally:
         db.close()
 
+def get_read_db():
+    db = ReadSessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def init_schema():
+    Base.metadata.create_all(bind=engine)
+    with SessionLocal() as session:
+        # costs could be inserted twice before container_cost.container_id
+        # got its unique index
+        application_ids = crud.remove_duplicate_container_costs(session)
+        if application_ids:
+            crud.rebuild_application_summaries(session, application_ids)
+        session.commit()
+    if USAGE_PARTITIONING:
+        with engine.begin() as connection:
+            partitions.create_usage_partitions(connection, config.get_usage_partition_days_ahead())
+    create_indexes()
+
+def create_indexes():
+    # create_all skips existing tables, indexes added later are built here
+    # without blocking writes, which can't be done in a transaction
+    with engine.connect() as connection:
+        connection.execution_options(isolation_level="AUTOCOMMIT")
+        for table in Base.metadata.sorted_tables:
+            # partitioned tables are created with their indexes and can't
+            # build them concurrently
+            concurrently = not table.dialect_options["postgresql"]["partition_by"]
+            for index in table.indexes:
+                drop_invalid_index(connection, index.name)
+                index.dialect_options["postgresql"]["concurrently"] = concurrently
+                try:
+                    index.create(bind=connection, checkfirst=True)
+                finally:
+                    index.dialect_options["postgresql"]["concurrently"] = False
+
+def drop_invalid_index(connection, name: str):
+    # an interrupted concurrent build leaves an invalid index, which would
+    # be skipped as existing
+    stmt = text(
+        "SELECT 1 FROM pg_index JOIN pg_class ON pg_class.oid = pg_index.indexrelid "
+        "WHERE pg_class.relname = :name AND NOT pg_index.indisvalid"
+    )
+    if connection.scalar(stmt, {"name": name}):
+        connection.execute(text(f'DROP INDEX CONCURRENTLY "{name}"'))
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
@@ -3,3 +3,15 @@ from enum import Enum
 class Kind(Enum):
     ON_DEMAND = "on-demand"
     SPOT = "spot"
+
+class Status(Enum):
+    RUNNING = "running"
+    FINISHED = "finished"
+
+class ExportFormat(Enum):
+    JSON = "json"
+    CSV = "csv"
+
+class CostEngine(Enum):
+    AVERAGE = "average"
+    COUNTERS = "counters"
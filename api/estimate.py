@@ -0,0 +1,163 @@
+import asyncio
+import logging
+from collections import namedtuple
+
+import redis
+from starlette.concurrency import run_in_threadpool
+
+import cache
+import config
+import costs
+import crud
+import pricing
+from enums import Kind
+
+logger = logging.getLogger(__name__)
+
+# Running cost estimates of containers that have not been costed yet. Ingest
+# adds samples to in memory aggregates, which are flushed periodically to
+# redis where the aggregates of all api processes are merged. Without redis
+# every process only knows about the samples it received, and keeps the
+# aggregates of a bounded number of recently updated applications.
+
+Aggregate = namedtuple("Aggregate", ["instance_id", "sample_count", "cpu_usage_sum", "first_time", "last_time"])
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None and config.get_cost_estimate_url():
+        _redis = redis.Redis.from_url(config.get_cost_estimate_url())
+    return _redis
+
+def merge(aggregate: Aggregate | None, other: Aggregate):
+    if aggregate is None:
+        return other
+    return Aggregate(
+        other.instance_id,
+        aggregate.sample_count + other.sample_count,
+        aggregate.cpu_usage_sum + other.cpu_usage_sum,
+        min(aggregate.first_time, other.first_time),
+        max(aggregate.last_time, other.last_time),
+    )
+
+
+class CostEstimator:
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._totals = cache.LRUCache(config.get_cost_estimate_max_applications(), config.get_cost_estimate_ttl())
+        self._stopping = False
+        self._task = None
+
+    def add(self, instance_id: str, app: str, container: str, cpu_usage: float, time: int):
+        key = (app, container)
+        aggregate = self._pending.get(key)
+        if aggregate is None:
+            self._pending[key] = [instance_id, 1, cpu_usage, time, time]
+        else:
+            aggregate[1] += 1
+            aggregate[2] += cpu_usage
+            aggregate[3] = min(aggregate[3], time)
+            aggregate[4] = max(aggregate[4], time)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._stopping = True
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        await self.flush()
+
+    async def _run(self):
+        while not self._stopping:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def flush(self):
+        pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        if get_redis() is None:
+            for (app, container), aggregate in pending.items():
+                containers = self._totals.get(app) or {}
+                containers[container] = merge(containers.get(container), Aggregate(*aggregate))
+                self._totals.set(app, containers)
+            return
+        try:
+            await run_in_threadpool(self.write, pending)
+        except redis.RedisError:
+            logger.warning("Cost estimates unavailable, %d containers not updated", len(pending))
+
+    def write(self, pending: dict):
+        ttl = config.get_cost_estimate_ttl()
+        pipeline = get_redis().pipeline(transaction=False)
+        apps = set()
+        for (app, container), (instance_id, sample_count, cpu_usage_sum, first_time, last_time) in pending.items():
+            apps.add(app)
+            pipeline.hset(f"estimate:{app}:instance", container, instance_id)
+            pipeline.hincrby(f"estimate:{app}:count", container, sample_count)
+            pipeline.hincrbyfloat(f"estimate:{app}:cpu", container, cpu_usage_sum)
+            pipeline.zadd(f"estimate:{app}:first", {container: first_time}, lt=True)
+            pipeline.zadd(f"estimate:{app}:last", {container: last_time}, gt=True)
+        for app in apps:
+            for field in ("instance", "count", "cpu", "first", "last"):
+                pipeline.expire(f"estimate:{app}:{field}", ttl)
+        pipeline.execute()
+
+    def get_application(self, app: str):
+        client = get_redis()
+        if client is None:
+            return dict(self._totals.get(app) or {})
+        pipeline = client.pipeline(transaction=False)
+        pipeline.hgetall(f"estimate:{app}:instance")
+        pipeline.hgetall(f"estimate:{app}:count")
+        pipeline.hgetall(f"estimate:{app}:cpu")
+        pipeline.zrange(f"estimate:{app}:first", 0, -1, withscores=True)
+        pipeline.zrange(f"estimate:{app}:last", 0, -1, withscores=True)
+        try:
+            instances, counts, cpu, first, last = pipeline.execute()
+        except redis.RedisError:
+            logger.warning("Cost estimates unavailable, %s not read", app)
+            return {}
+        first = dict(first)
+        last = dict(last)
+        return {
+            container.decode(): Aggregate(instance_id.decode(), int(counts[container]), float(cpu[container]), int(first[container]), int(last[container]))
+            for container, instance_id in instances.items()
+            if container in counts and container in cpu and container in first and container in last
+        }
+
+
+def get_current_price(instance, time: int):
+    # cached prices only, the api has no AWS credentials. Without a price the
+    # container is left out of the estimate.
+    if instance.kind == Kind.ON_DEMAND.value:
+        return pricing.get_cached_on_demand_hourly_price(instance.instance_type, instance.region)
+    # the current hour is never cached, the last complete one is when the
+    # worker costed a container on this instance type
+    hour = time - time % pricing.HOUR - pricing.HOUR
+    spot_prices = pricing.get_cached_hour_spot_prices(instance.instance_type, instance.az, hour)
+    if not spot_prices:
+        return None
+    return spot_prices[-1]["price"]
+
+def estimate_container_costs(session, aggregates: dict[str, Aggregate]):
+    instances = crud.get_instances_by_instance_ids(session, {aggregate.instance_id for aggregate in aggregates.values()})
+    prices = {}
+    estimates = {}
+    for container, aggregate in aggregates.items():
+        instance = instances.get(aggregate.instance_id)
+        if instance is None:
+            continue
+        if instance.id not in prices:
+            prices[instance.id] = get_current_price(instance, aggregate.last_time)
+        if prices[instance.id] is None:
+            continue
+        estimates[container] = costs.calculate_on_demand_cost(aggregate, prices[instance.id])
+    return estimates
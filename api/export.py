@@ -0,0 +1,104 @@
+import csv
+import io
+import json
+from datetime import datetime
+
+from sqlalchemy import Select, func, select
+
+import database
+from enums import ExportFormat
+from model import Application, ApplicationSummary, Container, ContainerCost, Instance
+
+# Exports stream rows from a server side cursor, only one chunk of rows is
+# held in memory at a time. Ranges are on the application start time.
+
+CHUNK_SIZE = 1000
+
+
+def applications_query(start: datetime | None, end: datetime | None):
+    stmt = (select(
+                Application.name.label("application"),
+                ApplicationSummary.start_time,
+                ApplicationSummary.finish_time,
+                ApplicationSummary.finished,
+                ApplicationSummary.container_count,
+                ApplicationSummary.total_cost.label("cost"))
+            .join(ApplicationSummary, ApplicationSummary.application_id == Application.id)
+            .order_by(ApplicationSummary.start_time, ApplicationSummary.application_id))
+    return filter_start_time(stmt, ApplicationSummary.start_time, start, end)
+
+def containers_query(start: datetime | None, end: datetime | None):
+    stmt = (select(
+                Container.name.label("container"),
+                Application.name.label("application"),
+                Instance.instance_id,
+                Instance.instance_type,
+                Instance.kind,
+                Container.finished,
+                ContainerCost.amount.label("cost"))
+            .join(Application, Container.application)
+            .join(Instance, Container.instance)
+            .outerjoin(ContainerCost, Container.cost)
+            .order_by(Container.id))
+    return filter_start_time(stmt, Application.start_time, start, end)
+
+def instances_query(start: datetime | None, end: datetime | None):
+    stmt = (select(
+                Instance.instance_id,
+                Instance.instance_type,
+                Instance.kind,
+                Instance.region,
+                Instance.az,
+                func.count(Container.id).label("container_count"),
+                func.coalesce(func.sum(ContainerCost.amount), 0).label("cost"))
+            .join(Container, Instance.containers)
+            .join(Application, Container.application)
+            .outerjoin(ContainerCost, Container.cost)
+            .group_by(Instance.id)
+            .order_by(Instance.id))
+    return filter_start_time(stmt, Application.start_time, start, end)
+
+def filter_start_time(stmt: Select, column, start: datetime | None, end: datetime | None):
+    if start is not None:
+        stmt = stmt.where(column >= start)
+    if end is not None:
+        stmt = stmt.where(column < end)
+    return stmt
+
+def format_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+def stream(stmt: Select, export_format: ExportFormat):
+    # the session lives as long as the response, not the request handler
+    session = database.ReadSessionLocal()
+    try:
+        result = session.execute(stmt.execution_options(yield_per=CHUNK_SIZE))
+        columns = list(result.keys())
+        if export_format == ExportFormat.CSV:
+            yield from stream_csv(result, columns)
+        else:
+            yield from stream_json(result, columns)
+    finally:
+        session.close()
+
+def stream_csv(result, columns):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for rows in result.partitions():
+        writer.writerows([format_value(value) for value in row] for row in rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue()
+
+def stream_json(result, columns):
+    yield "["
+    separator = ""
+    for rows in result.partitions():
+        chunk = ",".join(json.dumps({column: format_value(value) for column, value in zip(columns, row)}) for row in rows)
+        yield separator + chunk
+        separator = ","
+    yield "]"
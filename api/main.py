@@ -1,58 +1,423 @@
-from fastapi import Depends, FastAPI, Request
-from fastapi.responses import HTMLResponse
+import json
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+
+from fastapi import Depends, FastAPI, HTTPException, Query, Request, Response
+from fastapi.responses import HTMLResponse, StreamingResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
+from pydantic import ValidationError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from database import get_db
+from database import get_async_db, get_db, get_read_db
+from enums import ExportFormat, Status
+import buffer
+import cache
+import codec
+import config
+import estimate
+import export
+import metrics
+import pricing
+import response_cache
 import schema
+import timeseries
 import crud
-import worker
+import crud_async
+
+usage_buffer = None
+if config.get_usage_buffer_enabled():
+    usage_buffer = buffer.UsageBuffer(
+        config.get_usage_buffer_max_size(),
+        config.get_usage_buffer_flush_interval(),
+        config.get_usage_buffer_flush_rows(),
+    )
 
-app = FastAPI()
+cost_estimator = None
+if config.get_cost_estimate_enabled():
+    cost_estimator = estimate.CostEstimator(config.get_cost_estimate_flush_interval())
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if usage_buffer is not None:
+        usage_buffer.start()
+    if cost_estimator is not None:
+        cost_estimator.start()
+    yield
+    if usage_buffer is not None:
+        await usage_buffer.stop()
+    if cost_estimator is not None:
+        await cost_estimator.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 app.mount("/static", StaticFiles(directory="static"), name="static")
 
 templates = Jinja2Templates(directory="templates")
 
-@app.post("/instance")
-async def register_instance(instance_data: schema.InstanceCreate, db: Session = Depends(get_db)):
-    instance = crud.create_instance(db, instance_data)
-    db.commit()
-    db.close()
-    return {"id": instance.id}
-
-@app.post("/instance/{instance_id}/usage")
-async def handle_usage(instance_id: str, usage_data: schema.UsageCreate, db: Session = Depends(get_db)):
-    usage = crud.create_usage(db, instance_id, usage_data)
-    db.commit()
-    db.close()
-    return {"id": usage.id}
-
-@app.post("/container/{container_name}/finish")
-async def handle_container_finished(container_name: str, db: Session = Depends(get_db)):
-    container = crud.mark_container_finished(db, container_name)
-    db.commit()
-    db.close()
-    worker.calculate_container_cost.delay(container_name)
-    return {"id": container.id}
+@app.middleware("http")
+async def record_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    token = metrics.start_operation()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        # the route template, not the path, keeps the label set small
+        route = request.scope.get("route")
+        route = route.path if route is not None else "unmatched"
+        metrics.REQUEST_LATENCY.labels(request.method, route, status).observe(time.perf_counter() - start)
+        metrics.finish_operation(f"{request.method} {route}", token)
+
+def estimate_usage(instance_id: str, usage_data: schema.UsageCreate):
+    if cost_estimator is not None:
+        cost_estimator.add(instance_id, usage_data.app, usage_data.container, usage_data.cpu_usage, usage_data.time)
+
+def estimate_usage_records(instance_id: str, records: list[dict]):
+    if cost_estimator is None:
+        return
+    for data in records:
+        cost_estimator.add(instance_id, data["app"], data["container"], data["cpu_usage"], data["time"])
+
+def get_application_estimates(db: Session, app):
+    if cost_estimator is None or app.finished:
+        return {}
+    aggregates = cost_estimator.get_application(app.name)
+    costed = crud.get_costed_container_names(db, app.id, list(aggregates))
+    return estimate.estimate_container_costs(db, {name: aggregate for name, aggregate in aggregates.items() if name not in costed})
+
+def schedule_container_cost(container):
+    # celery and boto3 come with the worker, web pods load them on the first
+    # finished container instead of at startup
+    import worker
+
+    worker.schedule_container_cost(container)
+
+async def flush_usage_buffer():
+    # the agent posts the last sample of a container right before finishing
+    # it, buffered samples are written before the container is costed
+    if usage_buffer is not None:
+        await usage_buffer.flush()
+
+def queue_usage(instance_id: str, usage_data: schema.UsageCreate, response: Response):
+    try:
+        usage_buffer.put(instance_id, usage_data)
+    except buffer.BufferFull:
+        raise HTTPException(status_code=503, detail="Usage buffer is full.", headers={"Retry-After": "1"})
+    response.status_code = 202
+    return {"status": "queued"}
+
+async def parse_usage_batch(request: Request):
+    try:
+        body = codec.decode_body(await request.body(), request.headers.get("content-encoding"))
+    except codec.UnsupportedEncoding as e:
+        raise HTTPException(status_code=415, detail=str(e))
+    except codec.BodyTooLarge:
+        raise HTTPException(status_code=413, detail="Decoded body is too large.")
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body could not be decompressed.")
+
+    content_type = request.headers.get("content-type", "")
+    if content_type.startswith(codec.MSGPACK_CONTENT_TYPES):
+        try:
+            return codec.unpack_usage_batch(body)
+        except (ValueError, TypeError, IndexError, KeyError):
+            raise HTTPException(status_code=400, detail="Body is not a valid msgpack usage batch.")
+    return validate_usage_batch(read_usage_batch(body, content_type))
+
+def read_usage_batch(body: bytes, content_type: str):
+    if content_type.startswith("application/x-ndjson"):
+        records = []
+        for line in body.splitlines():
+            if not line.strip():
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError as e:
+                records.append(e)
+        return records
+
+    try:
+        records = json.loads(body)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Body is not valid JSON.")
+    if not isinstance(records, list):
+        raise HTTPException(status_code=400, detail="Expected a JSON array of usage records.")
+    return records
+
+def validate_usage_batch(records):
+    results = []
+    valid = []
+    for record in records:
+        if isinstance(record, ValueError):
+            results.append({"status": "invalid", "errors": [{"msg": str(record)}]})
+            continue
+        try:
+            usage_data = schema.UsageCreate.model_validate(record)
+        except ValidationError as e:
+            results.append({"status": "invalid", "errors": e.errors(include_url=False, include_context=False)})
+            continue
+        results.append({"status": "created"})
+        valid.append((len(results) - 1, usage_data.model_dump()))
+    return results, valid
+
+def usage_batch_response(results, valid, ids):
+    for (i, _), usage_id in zip(valid, ids):
+        results[i]["id"] = usage_id
+    return {"created": len(ids), "invalid": len(results) - len(ids), "results": results}
+
+if config.get_db_async():
+    @app.post("/instance")
+    async def register_instance(instance_data: schema.InstanceCreate, db: AsyncSession = Depends(get_async_db)):
+        instance = await crud_async.create_instance(db, instance_data)
+        await db.commit()
+        return {"id": instance.id}
+
+    @app.post("/instance/{instance_id}/usage")
+    async def handle_usage(instance_id: str, usage_data: schema.UsageCreate, response: Response, db: AsyncSession = Depends(get_async_db)):
+        estimate_usage(instance_id, usage_data)
+        if usage_buffer is not None:
+            return queue_usage(instance_id, usage_data, response)
+        usage = await crud_async.create_usage(db, instance_id, usage_data)
+        await db.commit()
+        return {"id": usage.id}
+
+    @app.post("/instance/{instance_id}/usage/batch")
+    async def handle_usage_batch(instance_id: str, request: Request, db: AsyncSession = Depends(get_async_db)):
+        results, valid = await parse_usage_batch(request)
+        records = [data for _, data in valid]
+        estimate_usage_records(instance_id, records)
+        ids = await crud_async.create_usage_records(db, instance_id, records)
+        await db.commit()
+        return usage_batch_response(results, valid, ids)
+
+    @app.post("/container/{container_name}/finish")
+    async def handle_container_finished(container_name: str, db: AsyncSession = Depends(get_async_db)):
+        await flush_usage_buffer()
+        container = await crud_async.mark_container_finished(db, container_name)
+        await db.commit()
+        schedule_container_cost(container)
+        return {"id": container.id}
+else:
+    @app.post("/instance")
+    async def register_instance(instance_data: schema.InstanceCreate, db: Session = Depends(get_db)):
+        instance = crud.create_instance(db, instance_data)
+        db.commit()
+        db.close()
+        return {"id": instance.id}
+
+    @app.post("/instance/{instance_id}/usage")
+    async def handle_usage(instance_id: str, usage_data: schema.UsageCreate, response: Response, db: Session = Depends(get_db)):
+        estimate_usage(instance_id, usage_data)
+        if usage_buffer is not None:
+            return queue_usage(instance_id, usage_data, response)
+        usage = crud.create_usage(db, instance_id, usage_data)
+        db.commit()
+        db.close()
+        return {"id": usage.id}
+
+    @app.post("/instance/{instance_id}/usage/batch")
+    async def handle_usage_batch(instance_id: str, request: Request, db: Session = Depends(get_db)):
+        results, valid = await parse_usage_batch(request)
+        records = [data for _, data in valid]
+        estimate_usage_records(instance_id, records)
+        ids = crud.create_usage_records(db, instance_id, records)
+        db.commit()
+        db.close()
+        return usage_batch_response(results, valid, ids)
+
+    @app.post("/container/{container_name}/finish")
+    async def handle_container_finished(container_name: str, db: Session = Depends(get_db)):
+        await flush_usage_buffer()
+        container = crud.mark_container_finished(db, container_name)
+        db.commit()
+        db.close()
+        schedule_container_cost(container)
+        return {"id": container.id}
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**cache.stats(), "pages": response_cache.stats()}
+
+EXPORT_MEDIA_TYPES = {ExportFormat.JSON: "application/json", ExportFormat.CSV: "text/csv"}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    metrics.update_cache_stats({
+        **cache.stats(),
+        "pages": response_cache.stats(),
+        "price_on_demand": pricing.on_demand_prices.stats(),
+        "price_spot": pricing.spot_prices.stats(),
+    })
+    return Response(generate_latest(metrics.get_registry()), media_type=CONTENT_TYPE_LATEST)
+
+def export_response(stmt, name: str, export_format: ExportFormat):
+    return StreamingResponse(
+        export.stream(stmt, export_format),
+        media_type=EXPORT_MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{export_format.value}"'},
+    )
+
+@app.get("/export/applications")
+async def export_applications(start: datetime | None = None, end: datetime | None = None, format: ExportFormat = ExportFormat.JSON):
+    return export_response(export.applications_query(start, end), "applications", format)
+
+@app.get("/export/containers")
+async def export_containers(start: datetime | None = None, end: datetime | None = None, format: ExportFormat = ExportFormat.JSON):
+    return export_response(export.containers_query(start, end), "containers", format)
+
+@app.get("/export/instances")
+async def export_instances(start: datetime | None = None, end: datetime | None = None, format: ExportFormat = ExportFormat.JSON):
+    return export_response(export.instances_query(start, end), "instances", format)
+
+def series_response(
+    db: Session,
+    start: datetime | None,
+    end: datetime | None,
+    resolution: int | None,
+    max_points: int,
+    **filters,
+):
+    container_ids = crud.container_ids_query(**filters)
+    return timeseries.get_series(
+        db, container_ids, timeseries.to_timestamp(start), timeseries.to_timestamp(end), resolution, max_points)
+
+@app.get("/series/container/{name}")
+def container_series(
+    name: str,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    resolution: int | None = Query(default=None, ge=1),
+    max_points: int = Query(default=500, ge=3, le=5000),
+    db: Session = Depends(get_read_db),
+):
+    container = crud.get_container_by_name(db, name)
+    if container is None:
+        raise HTTPException(status_code=404, detail="Container not found.")
+    return series_response(db, start, end, resolution, max_points, id=container.id)
+
+@app.get("/series/application/{name}")
+def application_series(
+    name: str,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    resolution: int | None = Query(default=None, ge=1),
+    max_points: int = Query(default=500, ge=3, le=5000),
+    db: Session = Depends(get_read_db),
+):
+    app = crud.get_application_by_name(db, name)
+    if app is None:
+        raise HTTPException(status_code=404, detail="Application not found.")
+    return series_response(db, start, end, resolution, max_points, application_id=app.id)
+
+@app.get("/series/instance/{instance_id}")
+def instance_series(
+    instance_id: str,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    resolution: int | None = Query(default=None, ge=1),
+    max_points: int = Query(default=500, ge=3, le=5000),
+    db: Session = Depends(get_read_db),
+):
+    instance = crud.get_instance_by_instance_id(db, instance_id)
+    if instance is None:
+        raise HTTPException(status_code=404, detail="Instance not found.")
+    return series_response(db, start, end, resolution, max_points, instance_id=instance.id)
+
+@app.get("/estimate/{name}")
+def application_estimate(name: str, db: Session = Depends(get_read_db)):
+    row = crud.get_application_with_summary(db, name)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Application not found.")
+    app, summary = row
+    cost = summary.total_cost if summary is not None else crud.get_application_cost_by_name(db, name) or 0
+    estimates = get_application_estimates(db, app)
+    return {
+        "application": app.name,
+        "finished": app.finished,
+        "cost": cost,
+        "estimated_cost": cost + sum(estimates.values()),
+        "estimates": estimates,
+    }
+
+def parse_cursor(after: str):
+    start_time, _, application_id = after.rpartition("_")
+    try:
+        return datetime.fromisoformat(start_time), int(application_id)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
 
 @app.get("/", response_class=HTMLResponse)
-async def app_list_view(request: Request, db: Session = Depends(get_db)):
-    apps = crud.list_applications(db)
+async def app_list_view(
+    request: Request,
+    after: str | None = None,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    status: Status | None = None,
+    limit: int = Query(default=50, ge=1, le=500),
+    db: Session = Depends(get_read_db),
+):
+    cursor = None if after is None else parse_cursor(after)
+    finished = None if status is None else status == Status.FINISHED
+    apps = crud.list_applications(db, limit + 1, cursor, start, end, finished)
+
+    next_url = None
+    if len(apps) > limit:
+        apps = apps[:limit]
+        last = apps[-1][1]
+        next_url = request.url.include_query_params(after=f"{last.start_time.isoformat()}_{last.application_id}")
     return templates.TemplateResponse(
         request=request,
         name="list.html",
-        context={"applications": list(apps)}
+        context={"applications": apps, "next_url": next_url}
     )
 
 @app.get("/{name}", response_class=HTMLResponse)
-async def app_detail_view(request: Request, name: str, db: Session = Depends(get_db)):
-    app = crud.get_application_by_name(db, name)
-    cost = crud.get_application_cost_by_name(db, name)
-    
-    return templates.TemplateResponse(
+async def app_detail_view(
+    request: Request,
+    name: str,
+    after: int | None = None,
+    limit: int = Query(default=100, ge=1, le=1000),
+    db: Session = Depends(get_read_db),
+):
+    row = crud.get_application_with_summary(db, name)
+    if row is None:
+        raise HTTPException(status_code=404, detail="Application not found.")
+    app, summary = row
+
+    # pages of finished applications only change when a late cost arrives
+    cache_key = None
+    if app.finished and summary is not None:
+        cache_key = f"{app.id}:{summary.version}:{after}:{limit}"
+        headers = {"ETag": f'"{cache_key}"'}
+        if request.headers.get("if-none-match") == headers["ETag"]:
+            return Response(status_code=304, headers=headers)
+        body = response_cache.get(cache_key)
+        if body is not None:
+            return HTMLResponse(body, headers=headers)
+
+    if summary is not None:
+        cost = summary.total_cost
+    else:
+        cost = crud.get_application_cost_by_name(db, name)
+    containers = crud.list_application_containers(db, app.id, limit + 1, after)
+    estimates = get_application_estimates(db, app)
+
+    next_url = None
+    if len(containers) > limit:
+        containers = containers[:limit]
+        next_url = request.url.include_query_params(after=containers[-1].id)
+    response = templates.TemplateResponse(
         request=request,
         name="detail.html",
-        context={"app": app, "cost": cost}
+        context={"app": app, "cost": cost, "summary": summary, "containers": containers, "estimates": estimates, "next_url": next_url}
     )
+    if cache_key is not None:
+        response_cache.set(cache_key, response.body)
+        response.headers.update(headers)
+    return response
@@ -0,0 +1,34 @@
+import argparse
+import logging
+
+import crud
+import database
+
+logger = logging.getLogger(__name__)
+
+
+def migrate():
+    database.init_schema()
+    logger.info("Schema is up to date")
+
+def rebuild_summaries():
+    session = next(database.get_db())
+    try:
+        crud.rebuild_application_summaries(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+COMMANDS = {
+    "migrate": migrate,
+    "rebuild-summaries": rebuild_summaries,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Maintenance commands, run `migrate` before starting the api and the worker.")
+    parser.add_argument("command", choices=COMMANDS)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    COMMANDS[args.command]()
@@ -0,0 +1,143 @@
+import os
+import time
+from contextvars import ContextVar
+
+import redis
+from prometheus_client import REGISTRY, CollectorRegistry, Counter, Gauge, Histogram, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+from sqlalchemy import event
+from sqlalchemy.pool import AsyncAdaptedQueuePool, NullPool, QueuePool
+
+# Prometheus metrics of the api and the worker. The worker runs tasks in
+# forked processes, with PROMETHEUS_MULTIPROC_DIR set their metrics are
+# collected from files written by each of them.
+
+REQUEST_LATENCY = Histogram(
+    "spark_costs_http_request_duration_seconds",
+    "Time to handle a request",
+    ["method", "route", "status"],
+)
+OPERATION_STATEMENTS = Histogram(
+    "spark_costs_db_statements_per_operation",
+    "SQL statements executed by a request or task",
+    ["operation"],
+    buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 89, 144),
+)
+OPERATION_DB_TIME = Histogram(
+    "spark_costs_db_time_per_operation_seconds",
+    "Time spent executing SQL statements in a request or task",
+    ["operation"],
+)
+POOL_CHECKOUT = Histogram(
+    "spark_costs_db_pool_checkout_seconds",
+    "Time to get a connection from the pool, including connecting",
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+AWS_LATENCY = Histogram(
+    "spark_costs_aws_request_duration_seconds",
+    "Time of AWS pricing calls",
+    ["operation"],
+)
+TASK_DURATION = Histogram(
+    "spark_costs_task_duration_seconds",
+    "Time to run a celery task",
+    ["task", "state"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+TASK_LAG = Histogram(
+    "spark_costs_task_lag_seconds",
+    "Time between a task becoming due and a worker starting it",
+    ["task"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600),
+)
+TASK_RETRIES = Counter(
+    "spark_costs_task_retries_total",
+    "Celery task retries",
+    ["task"],
+)
+CACHE_HITS = Gauge("spark_costs_cache_hits", "Cache hits since the process started", ["cache"], multiprocess_mode="livesum")
+CACHE_MISSES = Gauge("spark_costs_cache_misses", "Cache misses since the process started", ["cache"], multiprocess_mode="livesum")
+CACHE_SIZE = Gauge("spark_costs_cache_size", "Cache entries", ["cache"], multiprocess_mode="livesum")
+
+# [statements, seconds] of the request or task being handled
+_operation = ContextVar("operation", default=None)
+
+
+def is_multiprocess():
+    return bool(os.environ.get("PROMETHEUS_MULTIPROC_DIR"))
+
+def get_registry():
+    if not is_multiprocess():
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+def start_operation():
+    return _operation.set([0, 0.0])
+
+def finish_operation(operation: str, token):
+    statements, seconds = _operation.get()
+    _operation.reset(token)
+    OPERATION_STATEMENTS.labels(operation).observe(statements)
+    OPERATION_DB_TIME.labels(operation).observe(seconds)
+
+def instrument_engine(engine):
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        operation = _operation.get()
+        if operation is not None:
+            operation[0] += 1
+            operation[1] += elapsed
+
+def update_cache_stats(stats: dict):
+    for name, values in stats.items():
+        if "hits" not in values:
+            continue
+        CACHE_HITS.labels(name).set(values["hits"])
+        CACHE_MISSES.labels(name).set(values["misses"])
+        CACHE_SIZE.labels(name).set(values["size"])
+
+
+class CheckoutTimer:
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            POOL_CHECKOUT.observe(time.perf_counter() - start)
+
+
+class InstrumentedQueuePool(CheckoutTimer, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(CheckoutTimer, AsyncAdaptedQueuePool):
+    pass
+
+
+class InstrumentedNullPool(CheckoutTimer, NullPool):
+    # every checkout opens a connection, used behind PgBouncer
+    pass
+
+
+class QueueDepthCollector:
+    # messages waiting in the redis broker lists, tasks with a countdown are
+    # held by the workers and not counted
+    def __init__(self, get_redis, queues):
+        self.get_redis = get_redis
+        self.queues = queues
+
+    def collect(self):
+        depth = GaugeMetricFamily("spark_costs_queue_depth", "Messages waiting in a celery queue", labels=["queue"])
+        try:
+            for queue in self.queues:
+                depth.add_metric([queue], self.get_redis().llen(queue))
+        except redis.RedisError:
+            return
+        yield depth
@@ -1,8 +1,12 @@
 from datetime import datetime
 from typing import Optional
-from sqlalchemy import ForeignKey
+from sqlalchemy import ForeignKey, Index
 from sqlalchemy.orm import DeclarativeBase, Mapped, mapped_column, relationship
 
+import config
+
+USAGE_PARTITIONING = config.get_usage_partitioning()
+
 class Base(DeclarativeBase):
     pass
 
@@ -10,7 +14,7 @@ class Instance(Base):
     __tablename__ = "instance"
 
     id: Mapped[int] = mapped_column(primary_key=True)
-    instance_id: Mapped[str]
+    instance_id: Mapped[str] = mapped_column(index=True)
     hostname: Mapped[str]
     kind: Mapped[str]
     instance_type: Mapped[str]
@@ -29,11 +33,30 @@ class Application(Base):
     id: Mapped[int] = mapped_column(primary_key=True)
     name: Mapped[str] = mapped_column(unique=True)
     finished: Mapped[bool] = mapped_column(default=False)
-    start_time: Mapped[datetime]
+    start_time: Mapped[datetime] = mapped_column(index=True)
     finish_time: Mapped[Optional[datetime]]
 
     containers: Mapped[list["Container"]] = relationship(back_populates="application")
 
+class ApplicationSummary(Base):
+    __tablename__ = "application_summary"
+    __table_args__ = (
+        Index("ix_application_summary_start_time_application_id", "start_time", "application_id"),
+    )
+
+    application_id: Mapped[int] = mapped_column(ForeignKey("application.id"), primary_key=True)
+    start_time: Mapped[datetime]
+    finish_time: Mapped[Optional[datetime]]
+    finished: Mapped[bool] = mapped_column(default=False)
+    total_cost: Mapped[float] = mapped_column(default=0)
+    container_count: Mapped[int] = mapped_column(default=0)
+    finished_count: Mapped[int] = mapped_column(default=0)
+    costed_count: Mapped[int] = mapped_column(default=0)
+    # bumped on every update, cached pages of the application depend on it
+    version: Mapped[int] = mapped_column(default=0)
+
+    application: Mapped[Application] = relationship()
+
 class Container(Base):
     __tablename__ = "container"
 
@@ -41,35 +64,60 @@ class Container(Base):
     name: Mapped[str] = mapped_column(unique=True)
     finished: Mapped[bool] = mapped_column(default=False)
     
-    instance_id: Mapped[int] = mapped_column(ForeignKey("instance.id"))
+    instance_id: Mapped[int] = mapped_column(ForeignKey("instance.id"), index=True)
     instance: Mapped[Instance] = relationship(back_populates="containers")
     usages: Mapped[list["Usage"]] = relationship(back_populates="container")
     
-    application_id: Mapped[int] = mapped_column(ForeignKey("application.id"))
+    application_id: Mapped[int] = mapped_column(ForeignKey("application.id"), index=True)
     application: Mapped[Application] = relationship(back_populates="containers")
 
     cost: Mapped["ContainerCost"] = relationship(back_populates="container")
 
 class Usage(Base):
     __tablename__ = "usage"
+    __table_args__ = (
+        Index("ix_usage_container_id_time", "container_id", "time"),
+        # partitioned by day, see partitions.py
+        {"postgresql_partition_by": "RANGE (time)"} if USAGE_PARTITIONING else {},
+    )
 
-    id: Mapped[int] = mapped_column(primary_key=True)
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True)
     pid: Mapped[int]
     start: Mapped[datetime]
     process_time: Mapped[float]
     cpu_time: Mapped[float]
     cpu_usage: Mapped[float]
-    time: Mapped[int]
+    # the partition key has to be a part of the primary key
+    time: Mapped[int] = mapped_column(primary_key=USAGE_PARTITIONING)
     
     container_id: Mapped[int] = mapped_column(ForeignKey("container.id"))
     container: Mapped[Container] = relationship(back_populates="usages")
 
+class UsageSummary(Base):
+    __tablename__ = "usage_summary"
+
+    container_id: Mapped[int] = mapped_column(ForeignKey("container.id"), primary_key=True)
+    sample_count: Mapped[int]
+    cpu_usage_sum: Mapped[float]
+    first_time: Mapped[int]
+    last_time: Mapped[int]
+
+class UsageBucket(Base):
+    __tablename__ = "usage_bucket"
+
+    container_id: Mapped[int] = mapped_column(ForeignKey("container.id"), primary_key=True)
+    # bucket length in seconds
+    resolution: Mapped[int] = mapped_column(primary_key=True)
+    time: Mapped[int] = mapped_column(primary_key=True)
+    sample_count: Mapped[int]
+    cpu_usage_sum: Mapped[float]
+
 class ContainerCost(Base):
     __tablename__ = "container_cost"
 
     id: Mapped[int] = mapped_column(primary_key=True)
     amount: Mapped[float]
 
-    container_id: Mapped[int] = mapped_column(ForeignKey("container.id"))
+    container_id: Mapped[int] = mapped_column(ForeignKey("container.id"), index=True, unique=True)
     container: Mapped[Container] = relationship(back_populates="cost")
 
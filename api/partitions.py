@@ -0,0 +1,47 @@
+from datetime import date, datetime, timedelta, timezone
+
+from sqlalchemy import Connection, text
+
+# usage.time holds unix timestamps, each partition covers one UTC day of them
+
+
+def partition_name(day: date):
+    return f"usage_p{day:%Y%m%d}"
+
+def day_start_timestamp(day: date):
+    return int(datetime(day.year, day.month, day.day, tzinfo=timezone.utc).timestamp())
+
+def create_usage_partitions(connection: Connection, days_ahead: int, today: date | None = None):
+    if today is None:
+        today = datetime.now(timezone.utc).date()
+    # yesterday is kept around for samples that arrive late
+    for offset in range(-1, days_ahead + 1):
+        day = today + timedelta(days=offset)
+        connection.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(day)} PARTITION OF usage "
+            f"FOR VALUES FROM ({day_start_timestamp(day)}) TO ({day_start_timestamp(day + timedelta(days=1))})"
+        ))
+
+def list_usage_partitions(connection: Connection):
+    stmt = text(
+        "SELECT child.relname FROM pg_inherits "
+        "JOIN pg_class parent ON parent.oid = pg_inherits.inhparent "
+        "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+        "WHERE parent.relname = 'usage'"
+    )
+    return list(connection.scalars(stmt))
+
+def drop_expired_usage_partitions(connection: Connection, retention_days: int, today: date | None = None):
+    if today is None:
+        today = datetime.now(timezone.utc).date()
+    cutoff = today - timedelta(days=retention_days)
+    dropped = []
+    for name in list_usage_partitions(connection):
+        try:
+            day = datetime.strptime(name, "usage_p%Y%m%d").date()
+        except ValueError:
+            continue
+        if day < cutoff:
+            connection.execute(text(f"DROP TABLE {name}"))
+            dropped.append(name)
+    return dropped
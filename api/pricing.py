@@ -0,0 +1,243 @@
+import argparse
+import json
+import logging
+import time
+from datetime import datetime
+
+import redis
+
+import aws
+import cache
+import config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+HOUR = 3600
+
+on_demand_prices = cache.LRUCache(1024, config.get_price_cache_ttl())
+spot_prices = cache.LRUCache(16384, config.get_price_cache_ttl())
+aws_calls = {"on_demand": 0, "spot": 0}
+
+_redis = None
+_snapshot = None
+
+
+def fetch_on_demand_hourly_price(instance_type, region="us-west-2"):
+    region_name = aws.get_region_name(region)
+    capacity_status = "Used"
+
+    filters = [
+        {"Field": "tenancy", "Value": "Shared", "Type": "TERM_MATCH"},
+        {"Field": "operatingSystem", "Value": "Linux", "Type": "TERM_MATCH"},
+        {"Field": "preInstalledSw", "Value": "NA", "Type": "TERM_MATCH"},
+        {"Field": "instanceType", "Value": instance_type, "Type": "TERM_MATCH"},
+        {"Field": "location", "Value": region_name, "Type": "TERM_MATCH"},
+        {"Field": "capacitystatus", "Value": capacity_status, "Type": "TERM_MATCH"},
+    ]
+    
+    aws_calls["on_demand"] += 1
+    client = aws.get_client("pricing", "us-east-1")
+    with metrics.AWS_LATENCY.labels("GetProducts").time():
+        response = client.get_products(ServiceCode="AmazonEC2", Filters=filters)
+    for price in response["PriceList"]:
+        price = json.loads(price)
+        price_value = None
+        
+        for on_demand in price["terms"]["OnDemand"].values():
+            for price_dimensions in on_demand["priceDimensions"].values():
+                price_value = price_dimensions["pricePerUnit"]["USD"]
+
+        if price_value is not None:
+            return float(price_value)
+
+    return None
+
+def fetch_spot_prices(instance_type, az, start_ts, end_ts, region="us-west-2"):
+    start_dt = datetime.fromtimestamp(start_ts)
+    end_dt = datetime.fromtimestamp(end_ts)
+
+    aws_calls["spot"] += 1
+    client = aws.get_client("ec2", region)
+    with metrics.AWS_LATENCY.labels("DescribeSpotPriceHistory").time():
+        response = client.describe_spot_price_history(
+            StartTime=start_dt,
+            EndTime=end_dt,
+            AvailabilityZone=az,
+            InstanceTypes=[instance_type],
+            ProductDescriptions=["Linux/UNIX"]
+        )
+    items = response["SpotPriceHistory"][::-1]
+    return [{"timestamp": datetime.timestamp(i["Timestamp"]), "price": float(i["SpotPrice"])} for i in items]
+
+
+def get_redis():
+    global _redis
+    if _redis is None and config.get_price_cache_url():
+        _redis = redis.Redis.from_url(config.get_price_cache_url())
+    return _redis
+
+def redis_get(key):
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        value = client.get(key)
+    except redis.RedisError:
+        logger.warning("Price cache unavailable, %s not read", key)
+        return None
+    return None if value is None else json.loads(value)
+
+def redis_set(key, value):
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.set(key, json.dumps(value), ex=config.get_price_cache_ttl())
+    except redis.RedisError:
+        logger.warning("Price cache unavailable, %s not stored", key)
+
+
+# Snapshot files hold records of the form
+#   {"on_demand": [{"instance_type", "region", "price"}, ...],
+#    "spot": [{"instance_type", "az", "timestamp", "price"}, ...]}
+# prices found in the snapshot never go to AWS.
+
+def load_snapshot(path):
+    with open(path, "r") as f:
+        data = json.load(f)
+    snapshot = {"on_demand": {}, "spot": {}}
+    for item in data.get("on_demand", []):
+        snapshot["on_demand"][(item["instance_type"], item["region"])] = float(item["price"])
+    for item in data.get("spot", []):
+        points = snapshot["spot"].setdefault((item["instance_type"], item["az"]), [])
+        points.append({"timestamp": float(item["timestamp"]), "price": float(item["price"])})
+    for points in snapshot["spot"].values():
+        points.sort(key=lambda point: point["timestamp"])
+    return snapshot
+
+def get_snapshot():
+    global _snapshot
+    if _snapshot is None:
+        path = config.get_price_snapshot_path()
+        _snapshot = load_snapshot(path) if path else {"on_demand": {}, "spot": {}}
+    return _snapshot
+
+def save_snapshot(path, on_demand, spot):
+    with open(path, "w") as f:
+        json.dump({"on_demand": on_demand, "spot": spot}, f, indent=2)
+
+
+# The get_cached_* functions only read the snapshot and the caches, they are
+# used by the api, which has no AWS credentials. Prices get into the caches
+# when the worker costs containers.
+
+def get_cached_on_demand_hourly_price(instance_type, region="us-west-2"):
+    key = (instance_type, region)
+    price = get_snapshot()["on_demand"].get(key)
+    if price is not None:
+        return price
+    price = on_demand_prices.get(key)
+    if price is not None:
+        return price
+    price = redis_get(f"price:on-demand:{instance_type}:{region}")
+    if price is not None:
+        on_demand_prices.set(key, price)
+    return price
+
+def get_on_demand_hourly_price(instance_type, region="us-west-2"):
+    price = get_cached_on_demand_hourly_price(instance_type, region)
+    if price is not None:
+        return price
+    price = fetch_on_demand_hourly_price(instance_type, region)
+    if price is None:
+        return None
+    redis_set(f"price:on-demand:{instance_type}:{region}", price)
+    on_demand_prices.set((instance_type, region), price)
+    return price
+
+def get_hour_spot_prices(points, hour):
+    # the price in effect when the hour starts and the changes within it
+    return clip_spot_prices(points, hour, hour + HOUR - 1)
+
+def clip_spot_prices(points, start_ts, end_ts):
+    effective = [point for point in points if point["timestamp"] <= start_ts][-1:]
+    return effective + [point for point in points if start_ts < point["timestamp"] <= end_ts]
+
+def get_cached_hour_spot_prices(instance_type, az, hour):
+    # None when the hour is not cached, the current hour never is
+    snapshot_points = get_snapshot()["spot"].get((instance_type, az))
+    if snapshot_points:
+        return get_hour_spot_prices(snapshot_points, hour)
+    key = (instance_type, az, hour)
+    points = spot_prices.get(key)
+    if points is None:
+        points = redis_get(f"price:spot:{instance_type}:{az}:{hour}")
+        if not points:
+            # empty hours stored by older versions are fetched again
+            return None
+        spot_prices.set(key, points)
+    return points
+
+def get_spot_prices(instance_type, az, start_ts, end_ts, region="us-west-2"):
+    snapshot_points = get_snapshot()["spot"].get((instance_type, az))
+    if snapshot_points:
+        return clip_spot_prices(snapshot_points, start_ts, end_ts)
+
+    hours = {}
+    missing = []
+    for hour in range(int(start_ts) - int(start_ts) % HOUR, int(end_ts) + 1, HOUR):
+        points = get_cached_hour_spot_prices(instance_type, az, hour)
+        if points is None:
+            missing.append(hour)
+        else:
+            hours[hour] = points
+
+    if missing:
+        # one call covers all the hours that were not cached
+        fetched = fetch_spot_prices(instance_type, az, missing[0], missing[-1] + HOUR, region)
+        now = time.time()
+        for hour in missing:
+            hours[hour] = get_hour_spot_prices(fetched, hour)
+            # the current hour may still change, an empty answer is asked
+            # for again
+            if hour + HOUR <= now and hours[hour]:
+                spot_prices.set((instance_type, az, hour), hours[hour])
+                redis_set(f"price:spot:{instance_type}:{az}:{hour}", hours[hour])
+
+    merged = {}
+    for hour in sorted(hours):
+        for point in hours[hour]:
+            merged[point["timestamp"]] = point
+    return clip_spot_prices([merged[timestamp] for timestamp in sorted(merged)], start_ts, end_ts)
+
+def stats():
+    return {
+        "on_demand": on_demand_prices.stats(),
+        "spot": spot_prices.stats(),
+        "aws_calls": dict(aws_calls),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write a price snapshot for offline cost calculation.")
+    parser.add_argument("path")
+    parser.add_argument("--instance-types", nargs="+", required=True)
+    parser.add_argument("--region", default="us-west-2")
+    parser.add_argument("--azs", nargs="*", default=[])
+    parser.add_argument("--start", type=datetime.fromisoformat, help="start of the spot price history")
+    parser.add_argument("--end", type=datetime.fromisoformat, default=datetime.now())
+    args = parser.parse_args()
+    if args.azs and args.start is None:
+        parser.error("--start is required with --azs")
+
+    on_demand = []
+    spot = []
+    for instance_type in args.instance_types:
+        price = fetch_on_demand_hourly_price(instance_type, args.region)
+        if price is not None:
+            on_demand.append({"instance_type": instance_type, "region": args.region, "price": price})
+        for az in args.azs:
+            for point in fetch_spot_prices(instance_type, az, args.start.timestamp(), args.end.timestamp(), args.region):
+                spot.append({"instance_type": instance_type, "az": az, **point})
+    save_snapshot(args.path, on_demand, spot)
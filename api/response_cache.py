@@ -0,0 +1,52 @@
+import logging
+
+import redis
+
+import cache
+import config
+
+logger = logging.getLogger(__name__)
+
+# Rendered pages of finished applications. Keys carry the application
+# summary version, which changes with every write to the summary, so a late
+# ContainerCost makes the old entries unreachable.
+
+pages = cache.LRUCache(config.get_response_cache_size(), config.get_response_cache_ttl())
+
+_redis = None
+
+
+def get_redis():
+    global _redis
+    if _redis is None and config.get_response_cache_url():
+        _redis = redis.Redis.from_url(config.get_response_cache_url())
+    return _redis
+
+def get(key: str):
+    body = pages.get(key)
+    if body is not None:
+        return body
+    client = get_redis()
+    if client is None:
+        return None
+    try:
+        body = client.get(f"page:{key}")
+    except redis.RedisError:
+        logger.warning("Response cache unavailable, rendering %s", key)
+        return None
+    if body is not None:
+        pages.set(key, body)
+    return body
+
+def set(key: str, body: bytes):
+    pages.set(key, body)
+    client = get_redis()
+    if client is None:
+        return
+    try:
+        client.set(f"page:{key}", body, ex=config.get_response_cache_ttl())
+    except redis.RedisError:
+        logger.warning("Response cache unavailable, %s not stored", key)
+
+def stats():
+    return pages.stats()
@@ -0,0 +1,127 @@
+import bisect
+import calendar
+import math
+from datetime import datetime
+
+from sqlalchemy import Select
+from sqlalchemy.orm import Session
+
+import crud
+import pricing
+from enums import Kind
+
+# CPU usage and cost of a set of containers over time, for charts. Points are
+# bucketed in SQL at a resolution that keeps the response within max_points,
+# an explicitly requested finer resolution is downsampled with LTTB instead.
+
+# bucket sizes picked automatically, in seconds
+RESOLUTIONS = (1, 5, 10, 15, 30, 60, 120, 300, 600, 900, 1800, 3600, 7200, 10800, 21600, 43200, 86400)
+# buckets computed in SQL for one response, finer resolutions are coarsened
+MAX_BUCKETS = 100_000
+
+
+def to_timestamp(value: datetime | None):
+    # naive datetimes are UTC, like the times sent by the agents
+    if value is None:
+        return None
+    return calendar.timegm(value.utctimetuple())
+
+def pick_resolution(span: int, max_points: int):
+    target = math.ceil(span / max_points)
+    for resolution in RESOLUTIONS:
+        if resolution >= target:
+            return resolution
+    return math.ceil(target / RESOLUTIONS[-1]) * RESOLUTIONS[-1]
+
+def round_resolution(resolution: int):
+    # buckets from a minute up are summed from the rollups, which only add up
+    # to whole minutes, other resolutions would have to read the raw samples
+    if resolution <= crud.USAGE_BUCKET_RESOLUTION:
+        return resolution
+    return math.ceil(resolution / crud.USAGE_BUCKET_RESOLUTION) * crud.USAGE_BUCKET_RESOLUTION
+
+def lttb(points: list[tuple], threshold: int):
+    # largest triangle three buckets on (time, value, ...) points, keeps the
+    # first and the last point and from every bucket in between the one
+    # forming the largest triangle with the point kept before it and the
+    # average of the next bucket
+    if threshold < 3 or len(points) <= threshold:
+        return points
+    every = (len(points) - 2) / (threshold - 2)
+    sampled = [points[0]]
+    a = 0
+    for i in range(threshold - 2):
+        start = int(i * every) + 1
+        end = int((i + 1) * every) + 1
+        following = points[end:min(int((i + 2) * every) + 1, len(points) - 1)] or points[-1:]
+        average_x = sum(point[0] for point in following) / len(following)
+        average_y = sum(point[1] for point in following) / len(following)
+        ax, ay = points[a][0], points[a][1]
+        a = max(range(start, end), key=lambda j: abs(
+            (ax - average_x) * (points[j][1] - ay) - (ax - points[j][0]) * (average_y - ay)))
+        sampled.append(points[a])
+    sampled.append(points[-1])
+    return sampled
+
+def get_hour_prices(instance, hour: int):
+    # (times, prices) of the hour, a price applies from its time until the
+    # next one. Only cached prices are used, the api has no AWS credentials,
+    # None when the prices of the hour are not cached, e.g. the current one.
+    if instance.kind == Kind.ON_DEMAND.value:
+        price = pricing.get_cached_on_demand_hourly_price(instance.instance_type, instance.region)
+        return None if price is None else ([hour], [price])
+    points = pricing.get_cached_hour_spot_prices(instance.instance_type, instance.az, hour)
+    if not points:
+        return None
+    # the price in effect when the hour starts applies from its start
+    return [max(point["timestamp"], hour) for point in points], [point["price"] for point in points]
+
+def price_at(price_points, time: int):
+    times, prices = price_points
+    return prices[max(bisect.bisect_right(times, time) - 1, 0)]
+
+def get_series(
+    session: Session,
+    container_ids: Select,
+    start: int | None,
+    end: int | None,
+    resolution: int | None,
+    max_points: int,
+):
+    first_time, last_time = crud.get_usage_time_range(session, container_ids)
+    start = first_time if start is None else start
+    end = last_time + 1 if end is None and last_time is not None else end
+    if start is None or end is None or end <= start:
+        return {"resolution": resolution, "downsampled": False, "time": [], "cpu_usage": [], "cost": []}
+
+    span = end - start
+    if resolution is None:
+        resolution = pick_resolution(span, max_points)
+    resolution = round_resolution(max(resolution, math.ceil(span / MAX_BUCKETS)))
+    rows = crud.get_usage_series(session, container_ids, resolution, start, end)
+
+    instances = crud.get_instances_by_ids(session, {row.instance_id for row in rows})
+    prices = {}
+    buckets = {}
+    for row in rows:
+        bucket = buckets.setdefault(row.time, [0.0, 0.0])
+        bucket[0] += row.cpu_usage
+        hour = row.time - row.time % pricing.HOUR
+        if (row.instance_id, hour) not in prices:
+            prices[row.instance_id, hour] = get_hour_prices(instances[row.instance_id], hour)
+        price_points = prices[row.instance_id, hour]
+        if price_points is None or bucket[1] is None:
+            # unknown price, the cost of the bucket is unknown too
+            bucket[1] = None
+        else:
+            bucket[1] += price_at(price_points, row.time) * row.cpu_seconds / 3600
+
+    points = [(time, cpu_usage, cost) for time, (cpu_usage, cost) in sorted(buckets.items())]
+    sampled = lttb(points, max_points)
+    return {
+        "resolution": resolution,
+        "downsampled": len(sampled) < len(points),
+        "time": [point[0] for point in sampled],
+        "cpu_usage": [point[1] for point in sampled],
+        "cost": [point[2] for point in sampled],
+    }
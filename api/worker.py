@@ -1,80 +1,124 @@
+import logging
 import os
-import json
+import time
 from datetime import datetime
 
-import boto3
+import numpy as np
+import redis
 from celery import Celery
+from celery.signals import (
+    before_task_publish,
+    task_postrun,
+    task_prerun,
+    task_retry,
+    worker_init,
+    worker_process_init,
+    worker_process_shutdown,
+)
+from prometheus_client import multiprocess, start_http_server
 
+import aws
+import cache
 import config
+import costs
 import crud
 import database
-from enums import Kind
+import metrics
+import partitions
+import pricing
+from enums import CostEngine, Kind
 
 
+logger = logging.getLogger(__name__)
+
 celery = Celery(__name__)
 celery.conf.broker_url = os.environ.get("CELERY_BROKER_URL", "redis://redis:6379")
 celery.conf.result_backend = os.environ.get("CELERY_RESULT_BACKEND", "redis://redis:6379")
+celery.conf.beat_schedule = {}
+if config.get_usage_partitioning():
+    celery.conf.beat_schedule["maintain_usage_partitions"] = {
+        "task": "maintain_usage_partitions",
+        "schedule": 3600,
+    }
+if config.get_usage_compaction() and config.get_usage_bucket_retention_days() > 0:
+    celery.conf.beat_schedule["expire_usage_buckets"] = {
+        "task": "expire_usage_buckets",
+        "schedule": 3600,
+    }
 
-AWS_REGION_MAP = config.load_region_map()
-
-def calculate_cost(price, elapsed_hours, avg_cpu_usage_percent):
-    return price * elapsed_hours * avg_cpu_usage_percent / 100
-
-
-def get_elapsed_hours(first_ts, last_ts):
-    first_dt = datetime.fromtimestamp(first_ts)
-    last_dt = datetime.fromtimestamp(last_ts)
-    elapsed_td = last_dt - first_dt
-    return elapsed_td.days * 24 + elapsed_td.seconds / 3600
-
+_redis = None
+# start time and metrics token of the tasks running in this process
+_running_tasks = {}
 
-def get_region_name(region):
-    aws_region_map = config.load_region_map()
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    # connections inherited from the parent process can't be used after fork
+    database.engine.dispose(close=False)
+    database.read_engine.dispose(close=False)
+    aws.init()
 
-    region_name = aws_region_map[region]["description"]
-    region_name = region_name.replace("Europe", "EU")
-    return region_name
+@worker_init.connect
+def start_metrics_server(**kwargs):
+    port = config.get_metrics_port()
+    if port <= 0:
+        return
+    registry = metrics.get_registry()
+    registry.register(metrics.QueueDepthCollector(get_redis, [celery.conf.task_default_queue]))
+    start_http_server(port, registry=registry)
 
+@worker_process_shutdown.connect
+def stop_worker_process(pid=None, **kwargs):
+    if metrics.is_multiprocess():
+        multiprocess.mark_process_dead(pid)
 
-def get_on_demand_hourly_price(instance_type, region="us-west-2"):
-    region_name = get_region_name(region)
-    capacity_status = "Used"
+@before_task_publish.connect
+def add_publish_time(headers=None, **kwargs):
+    headers["published_at"] = time.time()
 
-    filters = [
-        {"Field": "tenancy", "Value": "Shared", "Type": "TERM_MATCH"},
-        {"Field": "operatingSystem", "Value": "Linux", "Type": "TERM_MATCH"},
-        {"Field": "preInstalledSw", "Value": "NA", "Type": "TERM_MATCH"},
-        {"Field": "instanceType", "Value": instance_type, "Type": "TERM_MATCH"},
-        {"Field": "location", "Value": region_name, "Type": "TERM_MATCH"},
-        {"Field": "capacitystatus", "Value": capacity_status, "Type": "TERM_MATCH"},
-    ]
-    
-    client = boto3.client("pricing", region_name="us-east-1")
-    response = client.get_products(ServiceCode="AmazonEC2", Filters=filters)
-    for price in response["PriceList"]:
-        price = json.loads(price)
-        price_value = None
-        
-        for on_demand in price["terms"]["OnDemand"].values():
-            for price_dimensions in on_demand["priceDimensions"].values():
-                price_value = price_dimensions["pricePerUnit"]["USD"]
+@task_prerun.connect
+def start_task_metrics(task_id=None, task=None, **kwargs):
+    now = time.time()
+    published_at = getattr(task.request, "published_at", None)
+    if published_at is not None:
+        # tasks with a countdown are due at their eta
+        due = published_at
+        eta = task.request.eta
+        if eta:
+            if isinstance(eta, str):
+                eta = datetime.fromisoformat(eta)
+            due = max(due, eta.timestamp())
+        metrics.TASK_LAG.labels(task.name).observe(max(now - due, 0))
+    _running_tasks[task_id] = (time.perf_counter(), metrics.start_operation())
 
-        if price_value is not None:
-            return float(price_value)
+@task_postrun.connect
+def finish_task_metrics(task_id=None, task=None, state=None, **kwargs):
+    running = _running_tasks.pop(task_id, None)
+    if running is None:
+        return
+    start, token = running
+    metrics.TASK_DURATION.labels(task.name, state or "UNKNOWN").observe(time.perf_counter() - start)
+    metrics.finish_operation(task.name, token)
+    metrics.update_cache_stats({
+        **cache.stats(),
+        "price_on_demand": pricing.on_demand_prices.stats(),
+        "price_spot": pricing.spot_prices.stats(),
+    })
 
-    return None
+@task_retry.connect
+def count_task_retry(sender=None, **kwargs):
+    metrics.TASK_RETRIES.labels(sender.name).inc()
 
 def calculate_container_cost_amount(session, container, price):
-    first_usage = crud.get_container_first_usage(session, container)
-    last_usage = crud.get_container_last_usage(session, container)
-    elapsed_hours = get_elapsed_hours(first_usage.time, last_usage.time)
-    average_cpu_usage = crud.get_container_average_cpu_usage(session, container)
-    container_cost_amount = calculate_cost(price, elapsed_hours, average_cpu_usage)
-    return container_cost_amount
+    summary = crud.get_container_usage_summary(session, container)
+    if config.get_cost_engine() == CostEngine.COUNTERS:
+        amounts = calculate_counter_costs(session, {container.id: summary}, {container.id: on_demand_price_arrays(price)})
+        if container.id in amounts:
+            return amounts[container.id]
+    return costs.calculate_on_demand_cost(summary, price)
     
 
 def process_on_demand_container(session, container):
-    price = get_on_demand_hourly_price(container.instance.instance_type, container.instance.region)
+    price = pricing.get_on_demand_hourly_price(container.instance.instance_type, container.instance.region)
     if price is None:
         # TODO: Custom exception
         raise Exception("Price for instance not found.")
@@ -83,64 +127,270 @@ def process_on_demand_container(session, container):
     crud.create_container_cost(session, container, container_cost_amount)
     crud.maybe_update_application_finish_time(session, container)
 
-def get_spot_prices(instance_type, az, start_ts, end_ts, region="us-west-2"):
-    start_dt = datetime.fromtimestamp(start_ts)
-    end_dt = datetime.fromtimestamp(end_ts)
-
-    client = boto3.client("ec2", region_name=region)
-    response = client.describe_spot_price_history(
-        StartTime=start_dt,
-        EndTime=end_dt,
-        AvailabilityZone=az,
-        InstanceTypes=[instance_type],
-        ProductDescriptions=["Linux/UNIX"]
-    )
-    items = response["SpotPriceHistory"][::-1]
-    return [{"timestamp": datetime.timestamp(i["Timestamp"]), "price": float(i["SpotPrice"])} for i in items]
+def calculate_spot_cost(times, cpu_usage, price_times, prices):
+    # every sample holds the cpu usage since the previous one, cpu seconds
+    # consumed are piecewise linear in time between samples
+    cpu_seconds = np.concatenate(([0.0], np.cumsum(cpu_usage[1:] / 100 * np.diff(times))))
+    inner = price_times[(price_times > times[0]) & (price_times < times[-1])]
+    bounds = np.concatenate(([times[0]], inner, [times[-1]]))
+    consumed = np.diff(np.interp(bounds, times, cpu_seconds))
+    # usage before the first price point is charged the first price
+    price_index = np.clip(np.searchsorted(price_times, bounds[:-1], side="right") - 1, 0, None)
+    return float(np.sum(prices[price_index] * consumed) / 3600)
+
+def calculate_spot_cost_from_series(series, spot_prices):
+    times = np.array([row.time for row in series], dtype=float)
+    cpu_usage = np.array([row.cpu_usage for row in series], dtype=float)
+    return calculate_spot_cost(times, cpu_usage, *spot_price_arrays(spot_prices))
+
+def spot_price_arrays(spot_prices):
+    price_times = np.array([price["timestamp"] for price in spot_prices], dtype=float)
+    prices = np.array([price["price"] for price in spot_prices], dtype=float)
+    return price_times, prices
+
+def on_demand_price_arrays(price):
+    return np.array([0.0]), np.array([price])
+
+def calculate_counter_cost(counters, price_times, prices):
+    # counters are (time, process_time, cpu_time) at the segment bounds, the
+    # process share of the instance cpu in a segment is the ratio of the
+    # counter deltas, regardless of how the samples were spaced
+    counters = np.array(counters, dtype=float)
+    deltas = np.diff(counters, axis=0)
+    if np.any(deltas < 0):
+        # counters were reset, e.g. the process was restarted
+        return None
+    share = np.divide(deltas[:, 1], deltas[:, 2], out=np.zeros(len(deltas)), where=deltas[:, 2] > 0)
+    price_index = np.clip(np.searchsorted(price_times, counters[:-1, 0], side="right") - 1, 0, None)
+    return float(np.sum(prices[price_index] * deltas[:, 0] * share) / 3600)
+
+def calculate_counter_costs(session, summaries, prices):
+    # segments are split at price changes, the counters are read only at
+    # the segment bounds
+    bounds = {}
+    for container_id, summary in summaries.items():
+        price_times = prices[container_id][0]
+        inner = price_times[(price_times > summary.first_time) & (price_times < summary.last_time)]
+        bounds[container_id] = [summary.first_time, *(int(t) for t in inner), summary.last_time]
+    counters = crud.get_usage_counters(session, sorted({(container_id, t) for container_id, times in bounds.items() for t in times}))
+
+    amounts = {}
+    for container_id, times in bounds.items():
+        points = [counters.get((container_id, t)) for t in times]
+        if None in points:
+            # compacted usage
+            continue
+        amount = calculate_counter_cost(points, *prices[container_id])
+        if amount is not None:
+            amounts[container_id] = amount
+    return amounts
 
 def process_spot_container(session, container):
-    first_usage = crud.get_container_first_usage(session, container)
-    last_usage = crud.get_container_last_usage(session, container)
-    spot_prices = get_spot_prices(
-        container.instance.instance_type, 
+    summary = crud.get_container_usage_summary(session, container)
+    spot_prices = pricing.get_spot_prices(
+        container.instance.instance_type,
         container.instance.az,
-        first_usage.time,
-        last_usage.time
+        summary.first_time,
+        summary.last_time,
+        container.instance.region,
     )
-    if len(spot_prices) == 1:
-        price = spot_prices[0]["price"]
-        container_cost_amount = calculate_container_cost_amount(session, container, price)
+    if not spot_prices:
+        # TODO: Custom exception
+        raise Exception("Price for instance not found.")
+
+    amounts = {}
+    if config.get_cost_engine() == CostEngine.COUNTERS:
+        amounts = calculate_counter_costs(session, {container.id: summary}, {container.id: spot_price_arrays(spot_prices)})
+    if container.id in amounts:
+        container_cost_amount = amounts[container.id]
     else:
-        container_cost_amount = 0
-        i = 0
-        for i in range(0, len(spot_prices) - 1):
-            current_price = spot_prices[i]
-            start_ts = current_price["timestamp"]
-            end_ts =  spot_prices[i + 1]["timestamp"]
-            average_cpu_usage = crud.get_container_average_cpu_usage_for_time_range(session, container, start_ts, end_ts)
-            elapsed_hours = get_elapsed_hours(start_ts, end_ts)
-            container_cost_amount += calculate_cost(current_price["price"], elapsed_hours, average_cpu_usage)
-            i += 1
-        
+        series = crud.get_container_cpu_usage_series(session, container)
+        container_cost_amount = calculate_spot_cost_from_series(series, spot_prices)
+
     crud.create_container_cost(session, container, container_cost_amount)
-    crud.maybe_update_application_finish_time(session, container, last_usage)
+    crud.maybe_update_application_finish_time(session, container, summary.last_time)
 
 @celery.task(name="calculate_container_cost")
 def calculate_container_cost(container_name):
-    # TODO: Logging
     session = next(database.get_db())
-    container = crud.get_container_by_name(session, container_name)
-    if container is None:
-        # TODO: custom exception
-        raise Exception("Container not found.")
-    if container.instance.kind == Kind.ON_DEMAND.value:
-        process_on_demand_container(session, container)
-    else:
-        process_spot_container(session, container)
-
-    crud.maybe_mark_application_finished(session, container.application_id)
-    # TODO: logging
-    session.commit()
-    session.close()
+    try:
+        container = crud.get_container_by_name(session, container_name)
+        if container is None:
+            logger.warning("Container %s not found, cost not calculated", container_name)
+            # TODO: custom exception
+            raise Exception("Container not found.")
+        try:
+            if container.instance.kind == Kind.ON_DEMAND.value:
+                process_on_demand_container(session, container)
+            else:
+                process_spot_container(session, container)
+            crud.maybe_mark_application_finished(session, container.application_id)
+            session.commit()
+        except Exception:
+            logger.exception("Cost of container %s not calculated", container_name)
+            raise
+    finally:
+        session.close()
+    logger.info("Cost of container %s calculated", container_name)
+    schedule_usage_compaction([container.id])
     return True
 
+def process_application_containers(session, containers):
+    summaries = crud.get_containers_usage_summaries(session, [container.id for container in containers])
+    containers = [container for container in containers if container.id in summaries]
+
+    prices = {}
+    for container in containers:
+        if container.instance.kind != Kind.ON_DEMAND.value:
+            continue
+        price = pricing.get_on_demand_hourly_price(container.instance.instance_type, container.instance.region)
+        if price is None:
+            # TODO: Custom exception
+            raise Exception("Price for instance not found.")
+        prices[container.id] = on_demand_price_arrays(price)
+
+    # containers on the same kind of spot instance share one price history
+    spot_groups = {}
+    for container in containers:
+        if container.instance.kind == Kind.ON_DEMAND.value:
+            continue
+        key = (container.instance.instance_type, container.instance.az, container.instance.region)
+        spot_groups.setdefault(key, []).append(container)
+    for (instance_type, az, region), group in spot_groups.items():
+        spot_prices = pricing.get_spot_prices(
+            instance_type,
+            az,
+            min(summaries[container.id].first_time for container in group),
+            max(summaries[container.id].last_time for container in group),
+            region,
+        )
+        if not spot_prices:
+            # TODO: Custom exception
+            raise Exception("Price for instance not found.")
+        price_arrays = spot_price_arrays(spot_prices)
+        for container in group:
+            prices[container.id] = price_arrays
+
+    amounts = {}
+    if config.get_cost_engine() == CostEngine.COUNTERS:
+        amounts = calculate_counter_costs(session, {container.id: summaries[container.id] for container in containers}, prices)
+
+    # the average engine, also for containers without usable counters
+    for container in containers:
+        if container.id in amounts:
+            continue
+        if container.instance.kind == Kind.ON_DEMAND.value:
+            amounts[container.id] = costs.calculate_on_demand_cost(summaries[container.id], prices[container.id][1][0])
+        else:
+            # series are read one container at a time, a chunk of long
+            # running containers doesn't fit in memory
+            series = crud.get_containers_cpu_usage_series(session, [container.id])[container.id]
+            times = np.array([row.time for row in series], dtype=float)
+            cpu_usage = np.array([row.cpu_usage for row in series], dtype=float)
+            amounts[container.id] = calculate_spot_cost(times, cpu_usage, *prices[container.id])
+
+    if containers:
+        crud.create_container_costs(session, containers[0].application_id, amounts)
+        last_time = max(summaries[container.id].last_time for container in containers)
+        crud.maybe_update_application_finish_time(session, containers[0], last_time)
+    return amounts
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.Redis.from_url(celery.conf.broker_url)
+    return _redis
+
+def schedule_container_cost(container):
+    countdown = config.get_cost_coalesce_seconds()
+    if countdown <= 0:
+        calculate_container_cost.delay(container.name)
+        return
+
+    # finish events of an application are collected for countdown seconds
+    # and costed by a single task
+    client = get_redis()
+    client.sadd(f"cost:pending:{container.application_id}", container.name)
+    scheduled = client.set(f"cost:scheduled:{container.application_id}", 1, nx=True, ex=countdown * 10 + 60)
+    if scheduled:
+        calculate_application_costs.apply_async((container.application_id,), countdown=countdown)
+
+@celery.task(name="calculate_application_costs", bind=True, max_retries=3)
+def calculate_application_costs(self, application_id):
+    client = get_redis()
+    pending_key = f"cost:pending:{application_id}"
+    # events arriving from now on schedule the next task
+    client.delete(f"cost:scheduled:{application_id}")
+    pipeline = client.pipeline()
+    pipeline.smembers(pending_key)
+    pipeline.delete(pending_key)
+    names, _ = pipeline.execute()
+    names = sorted(name.decode() for name in names)
+    if not names:
+        return 0
+
+    session = next(database.get_db())
+    try:
+        containers = crud.get_containers_with_instances(session, names)
+        amounts = process_application_containers(session, containers)
+        crud.maybe_mark_application_finished(session, application_id)
+        session.commit()
+    except Exception as e:
+        if self.request.retries < self.max_retries:
+            # kept for the retry
+            client.sadd(pending_key, *names)
+            raise self.retry(exc=e, countdown=config.get_cost_coalesce_seconds())
+        # e.g. a container without a price, which would fail the whole batch
+        # again, every container is costed on its own instead
+        logger.exception("Costs of %d containers of application %d not calculated, costing them one by one",
+                         len(names), application_id)
+        for name in names:
+            calculate_container_cost.delay(name)
+        return 0
+    finally:
+        session.close()
+
+    schedule_usage_compaction(sorted(amounts))
+    skipped = len(names) - len(amounts)
+    if skipped:
+        logger.warning("%d containers of application %d have no usage, cost not calculated", skipped, application_id)
+    return len(amounts)
+
+
+def schedule_usage_compaction(container_ids):
+    if not config.get_usage_compaction() or not container_ids:
+        return
+    # late samples still land in the raw table before it is compacted
+    compact_container_usage.apply_async((container_ids,), countdown=config.get_usage_compaction_delay())
+
+@celery.task(name="compact_container_usage")
+def compact_container_usage(container_ids):
+    session = next(database.get_db())
+    try:
+        deleted = crud.compact_container_usage(session, container_ids)
+        session.commit()
+    finally:
+        session.close()
+    logger.info("compacted usage of %d containers, %d samples deleted", len(container_ids), deleted)
+    return deleted
+
+@celery.task(name="expire_usage_buckets")
+def expire_usage_buckets():
+    day = 24 * 3600
+    before = int(time.time()) // day * day - config.get_usage_bucket_retention_days() * day
+    session = next(database.get_db())
+    try:
+        deleted = crud.delete_expired_usage_buckets(session, before)
+        session.commit()
+    finally:
+        session.close()
+    return deleted
+
+@celery.task(name="maintain_usage_partitions")
+def maintain_usage_partitions():
+    with database.engine.begin() as connection:
+        partitions.create_usage_partitions(connection, config.get_usage_partition_days_ahead())
+        retention_days = config.get_usage_retention_days()
+        if retention_days > 0:
+            return partitions.drop_expired_usage_partitions(connection, retention_days)
+    return []
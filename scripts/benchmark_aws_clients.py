@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+# Per task overhead of resolving a region name and building the pricing and
+# EC2 clients, before and after pooling them per worker process. No AWS
+# requests are made, credentials are only needed for signing.
+
+import argparse
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
+
+import boto3
+
+import aws
+import config
+
+
+def unpooled_task(region):
+    region_map = config.load_region_map()
+    region_map[region]["description"].replace("Europe", "EU")
+    boto3.client("pricing", region_name="us-east-1")
+    boto3.client("ec2", region_name=region)
+
+def pooled_task(region):
+    aws.get_region_name(region)
+    aws.get_client("pricing", "us-east-1")
+    aws.get_client("ec2", region)
+
+def measure(task, region, n):
+    timings = []
+    for _ in range(n):
+        start = time.perf_counter()
+        task(region)
+        timings.append((time.perf_counter() - start) * 1000)
+    timings.sort()
+    return statistics.median(timings), timings[int(len(timings) * 0.99) - 1]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", type=int, default=100)
+    parser.add_argument("--region", default="us-west-2")
+    args = parser.parse_args()
+
+    os.environ.setdefault("AWS_ACCESS_KEY_ID", "benchmark")
+    os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "benchmark")
+
+    start = time.perf_counter()
+    aws.init()
+    print(f"worker_process_init setup: {(time.perf_counter() - start) * 1000:.1f} ms")
+    for name, task in (("unpooled", unpooled_task), ("pooled", pooled_task)):
+        p50, p99 = measure(task, args.region, args.n)
+        print(f"{name:>9} per task: p50 {p50:.2f} ms, p99 {p99:.2f} ms")
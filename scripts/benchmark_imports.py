@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+
+# Import time benchmark for the api and the worker.
+#
+# Imports a module in fresh interpreters, the way a new pod starts, and
+# reports the median wall clock time, the slowest imports measured with
+# `python -X importtime` and any modules the web pods shouldn't load. Fails
+# when the median is over the budget or a forbidden module got imported, so
+# it can guard startup time in CI.
+#
+#   python scripts/benchmark_imports.py
+#   python scripts/benchmark_imports.py --module worker --allow-heavy --budget-ms 3000
+#
+# Importing doesn't connect to the database or redis, dummy connection
+# settings are enough.
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+API_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "api")
+
+# loaded on demand by the api, only the worker needs them at startup
+HEAVY_MODULES = ["boto3", "botocore", "celery", "kombu", "numpy", "pkg_resources", "worker"]
+
+ENV = {
+    "DB_HOST": "localhost",
+    "DB_PORT": "5432",
+    "DB_USER": "spark",
+    "DB_PASSWORD": "spark",
+    "DB_NAME": "spark_costs",
+}
+
+PROBE = """
+import sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(elapsed)
+print(" ".join(name for name in {heavy!r} if name in sys.modules and name != "{module}"))
+"""
+
+
+def run(code, importtime=False):
+    command = [sys.executable, "-W", "ignore"]
+    if importtime:
+        command += ["-X", "importtime"]
+    env = {**ENV, **os.environ}
+    return subprocess.run(command + ["-c", code], cwd=API_DIR, env=env, capture_output=True, text=True, check=True)
+
+def measure(args):
+    times = []
+    loaded = set()
+    for _ in range(args.runs):
+        lines = run(PROBE.format(module=args.module, heavy=HEAVY_MODULES)).stdout.splitlines()
+        times.append(float(lines[0]) * 1000)
+        loaded.update(lines[1].split() if len(lines) > 1 else [])
+    return times, loaded
+
+def slowest_imports(args):
+    # "import time: self [us] | cumulative | imported package", nesting is
+    # shown by indentation of the name
+    output = run(f"import {args.module}", importtime=True).stderr
+    imports = []
+    for line in output.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((int(cumulative_us) / 1000, int(self_us) / 1000, depth, name.strip()))
+    return sorted(imports, reverse=True)[:args.top]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=15, help="slowest imports to show")
+    parser.add_argument("--budget-ms", type=float, default=2000, help="fail when the median import takes longer")
+    parser.add_argument("--allow-heavy", action="store_true", help="don't fail when worker dependencies are imported")
+    args = parser.parse_args()
+
+    run(f"import {args.module}")  # compile the bytecode first
+    times, loaded = measure(args)
+    median = statistics.median(times)
+    print(f"import {args.module}: median {median:.0f} ms, min {min(times):.0f} ms, max {max(times):.0f} ms over {args.runs} runs")
+
+    print(f"{'cumulative':>12} {'self':>9}  module")
+    for cumulative, self_ms, depth, name in slowest_imports(args):
+        print(f"{cumulative:9.1f} ms {self_ms:6.1f} ms  {'  ' * depth}{name}")
+
+    failed = False
+    if loaded:
+        print(f"heavy modules imported: {', '.join(sorted(loaded))}")
+        failed = not args.allow_heavy
+    if median > args.budget_ms:
+        print(f"over the budget of {args.budget_ms:.0f} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+# Check of the usage series at resolutions the minute rollups don't divide.
+#
+# Sends two hours of samples of a new container at a constant cpu usage and
+# reads its series at every given resolution. Each series must hold one
+# bucket per bucket of samples, at the resolution the api reports, with the
+# same cpu usage as the samples. Resolutions like 70 or 90 seconds used to
+# come back empty.
+#
+#   python scripts/check_series_resolutions.py
+#   python scripts/check_series_resolutions.py --resolutions 90 150 5400
+
+import argparse
+import random
+import sys
+import time
+from datetime import datetime
+
+import httpx
+
+CPU_USAGE = 50.0
+
+
+def instance(instance_id):
+    return {
+        "instance_id": instance_id,
+        "hostname": instance_id,
+        "kind": "on-demand",
+        "instance_type": "m5.4xlarge",
+        "private_ip": f"10.1.1.{random.randint(2, 254)}",
+        "region": "us-west-2",
+        "az": "us-west-2a",
+        "image_id": "imageid",
+        "launch_time": str(datetime.now()),
+        "architecture": "x86_64",
+    }
+
+def samples(app, container, times):
+    for i, t in enumerate(times):
+        yield {
+            "pid": 4242,
+            "app": app,
+            "container": container,
+            "start": float(times[0] - 5),
+            "process_time": float(i),
+            "cpu_time": 2.0 * i,
+            "cpu_usage": CPU_USAGE,
+            "time": t,
+        }
+
+def check(series, requested, times):
+    resolution = series["resolution"]
+    expected = sorted({t - t % resolution for t in times})
+    problems = []
+    if resolution < requested:
+        problems.append(f"resolution {resolution} is finer than requested")
+    if series["time"] != expected:
+        problems.append(f"{len(series['time'])} buckets, expected {len(expected)}")
+    if any(abs(cpu_usage - CPU_USAGE) > 1e-6 for cpu_usage in series["cpu_usage"]):
+        problems.append(f"cpu usage between {min(series['cpu_usage'], default=None)} and {max(series['cpu_usage'], default=None)}, expected {CPU_USAGE}")
+    return resolution, problems
+
+def read_series(client, container, requested, times, timeout):
+    # samples may reach the database after the response, e.g. when ingest is
+    # buffered, the series is read until it checks out or the timeout
+    deadline = time.monotonic() + timeout
+    while True:
+        response = client.get(f"/series/container/{container}", params={"resolution": requested, "max_points": 5000})
+        if response.status_code != 404 or time.monotonic() > deadline:
+            response.raise_for_status()
+            resolution, problems = check(response.json(), requested, times)
+            if not problems or time.monotonic() > deadline:
+                return resolution, problems
+        time.sleep(0.5)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[7, 60, 61, 70, 90, 120, 150, 3600, 5400])
+    parser.add_argument("--interval", type=int, default=2, help="seconds between samples")
+    parser.add_argument("--timeout", type=float, default=10, help="seconds to wait for the samples to be stored")
+    args = parser.parse_args()
+
+    suffix = f"{random.randint(10**12, 10**13 - 1)}_{random.randint(1000, 9999)}"
+    app = f"application_{suffix}"
+    container = f"container_{suffix}_01_000001"
+    instance_id = f"i-{random.randint(16**16, 16**17 - 1):x}"
+    start = int(time.time()) - 3 * 3600
+    times = list(range(start, start + 2 * 3600 + 1, args.interval))
+
+    failed = False
+    with httpx.Client(base_url=args.url, timeout=60) as client:
+        client.post("/instance", json=instance(instance_id)).raise_for_status()
+        rows = list(samples(app, container, times))
+        for i in range(0, len(rows), 1000):
+            client.post(f"/instance/{instance_id}/usage/batch", json=rows[i:i + 1000]).raise_for_status()
+
+        for requested in args.resolutions:
+            resolution, problems = read_series(client, container, requested, times, args.timeout)
+            print(f"resolution {requested}: served at {resolution}, {'OK' if not problems else '; '.join(problems)}")
+            failed |= bool(problems)
+
+    print("FAILED" if failed else "OK")
+    sys.exit(1 if failed else 0)
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+# Local stand-in for the two AWS calls made by the worker, pricing
+# GetProducts and EC2 DescribeSpotPriceHistory, so that benchmarks run
+# offline. Point the worker at it with
+#
+#   AWS_ENDPOINT_URL=http://127.0.0.1:4566 AWS_ACCESS_KEY_ID=x AWS_SECRET_ACCESS_KEY=x
+#
+# Prices are made up but stable, the same instance type and hour always get
+# the same spot price.
+
+import argparse
+import json
+import time
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+from uuid import uuid4 as uuid
+
+# hourly on demand price of one vCPU, scaled by the instance size
+VCPU_PRICE = 0.048
+SIZES = {"large": 2, "xlarge": 4, "2xlarge": 8, "4xlarge": 16, "8xlarge": 32, "12xlarge": 48, "16xlarge": 64, "24xlarge": 96}
+
+EC2_NAMESPACE = "http://ec2.amazonaws.com/doc/2016-11-15/"
+
+
+def on_demand_price(instance_type):
+    size = instance_type.rsplit(".", 1)[-1]
+    return VCPU_PRICE * SIZES.get(size, 2)
+
+def spot_price(instance_type, az, hour):
+    # between 30% and 50% of the on demand price
+    noise = zlib.crc32(f"{instance_type}:{az}:{hour}".encode()) % 1000 / 1000
+    return round(on_demand_price(instance_type) * (0.3 + 0.2 * noise), 6)
+
+def parse_time(value):
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+def get_products(request):
+    filters = {f["Field"]: f["Value"] for f in request.get("Filters", [])}
+    instance_type = filters.get("instanceType", "m5.large")
+    product = {
+        "product": {"attributes": {"instanceType": instance_type, "location": filters.get("location", "")}},
+        "terms": {"OnDemand": {"term": {"priceDimensions": {"dimension": {
+            "unit": "Hrs",
+            "pricePerUnit": {"USD": f"{on_demand_price(instance_type):.6f}"},
+        }}}}},
+    }
+    return {"FormatVersion": "aws_v1", "PriceList": [json.dumps(product)]}
+
+def describe_spot_price_history(params):
+    instance_type = params.get("InstanceType.1", ["m5.large"])[0]
+    az = params.get("AvailabilityZone", ["us-west-2a"])[0]
+    start = parse_time(params["StartTime"][0]).replace(minute=0, second=0, microsecond=0)
+    end = parse_time(params["EndTime"][0])
+
+    # one price per hour, newest first, including the one in effect at start
+    items = []
+    hour = start
+    while hour <= end:
+        items.append(
+            "<item>"
+            f"<instanceType>{instance_type}</instanceType>"
+            "<productDescription>Linux/UNIX</productDescription>"
+            f"<spotPrice>{spot_price(instance_type, az, int(hour.timestamp()))}</spotPrice>"
+            f"<timestamp>{hour.strftime('%Y-%m-%dT%H:%M:%S.000Z')}</timestamp>"
+            f"<availabilityZone>{az}</availabilityZone>"
+            "</item>"
+        )
+        hour += timedelta(hours=1)
+    return (
+        f'<?xml version="1.0" encoding="UTF-8"?>'
+        f'<DescribeSpotPriceHistoryResponse xmlns="{EC2_NAMESPACE}">'
+        f"<requestId>{uuid()}</requestId>"
+        f"<spotPriceHistorySet>{''.join(reversed(items))}</spotPriceHistorySet>"
+        "<nextToken></nextToken>"
+        "</DescribeSpotPriceHistoryResponse>"
+    )
+
+
+class Handler(BaseHTTPRequestHandler):
+    latency = 0.0
+    calls = {}
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        time.sleep(self.latency)
+        target = self.headers.get("X-Amz-Target", "")
+        if target.endswith(".GetProducts"):
+            self.count("GetProducts")
+            self.reply(200, json.dumps(get_products(json.loads(body))), "application/x-amz-json-1.1")
+            return
+
+        params = parse_qs(body.decode())
+        action = params.get("Action", [""])[0]
+        if action == "DescribeSpotPriceHistory":
+            self.count(action)
+            self.reply(200, describe_spot_price_history(params), "text/xml")
+            return
+        self.reply(400, json.dumps({"__type": "UnknownOperationException", "message": target or action}), "application/json")
+
+    def count(self, action):
+        self.calls[action] = self.calls.get(action, 0) + 1
+
+    def reply(self, status, body, content_type):
+        body = body.encode()
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=4566)
+    parser.add_argument("--latency-ms", type=float, default=0, help="added to every response")
+    args = parser.parse_args()
+
+    Handler.latency = args.latency_ms / 1000
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"fake AWS listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print("calls:", Handler.calls)
@@ -1,58 +1,81 @@
 #!/usr/bin/env python3
 
-import requests as r
+# Load generator and benchmark for the ingest API and the cost worker.
+#
+# Simulates mon agents on a number of nodes, each running containers of
+# several applications, or replays a JSONL recording of such a run. Requests
+# go out over a pooled asyncio client, optionally rate limited. At the end it
+# reports request latency, ingest throughput and, given a database URL, rows
+# written per second and how long the worker took to cost finished
+# containers.
+#
+#   python scripts/fake_aws.py &
+#   python scripts/generate_usage.py --nodes 16 --apps 5 --containers 8 --samples 600 --batch 200
+#   python scripts/generate_usage.py --record run.jsonl --samples 100
+#   python scripts/generate_usage.py --replay run.jsonl --speed 10
+#
+# Recordings hold one event per line:
+#   {"type": "instance", "data": {...}}
+#   {"type": "usage", "instance_id": "i-...", "data": {...}}
+#   {"type": "finish", "container": "container_..."}
+
+import argparse
+import asyncio
+import gzip
+import json
+import os
 import random
+import sys
 import time
-from datetime import datetime, timedelta
+from collections import defaultdict, namedtuple
+from datetime import datetime
 from uuid import uuid4 as uuid
-from threading import Thread
-
-"""
-const (
-  USAGE_URL = "http://127.0.0.1:8000/instance/%s/usage"
-  INIT_URL = "http://127.0.0.1:8000/instance"
-  FINISHED_URL = "http://127.0.0.1:8000/container/%s/finished"
-)
-
-// /mnt1/yarn/usercache/hadoop/appcache/application_1697720075274_7464/container_1697720075274_7464_01_000036 <nil>
-
-type Usage struct {
-  PID int `json:"pid"`
-  App string `json:"app"`
-  Container string `json:"container"`
-  Start float64 `json:"start"`
-  ProcessTime float64 `json:"process_time"`
-  CPUTime float64 `json:"cpu_time"`
-  CPUUsage float64 `json:"cpu_usage"`
-  Time int64 `json:"time"`
-}
-
-type Instance struct {
-  InstanceId string `json:"instance_id"`
-  Hostname string `json:"hostname"`
-  Kind string `json:"kind"`
-  InstanceType string `json:"instance_type"`
-  PrivateIP string `json:"private_ip"`
-  Region string `json:"region"`
-  AvailabilityZone string `json:"az"`
-  ImageId string `json:"image_id"`
-  LaunchTime time.Time `json:"launch_time"`
-  Architecture string `json:"architecture"`
-}
-"""
-
-
-USAGE_URL = "http://127.0.0.1:8000/instance/{}/usage"
-INIT_URL = "http://127.0.0.1:8000/instance"
-FINISHED_URL = "http://127.0.0.1:8000/container/{}/finish"
+
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "api"))
 
 NODE_TYPES = ["m5.8xlarge", "m5.16xlarge", "m5.4xlarge"]
 NODE_KINDS = ["on-demand", "spot"]
 
-def generate_nodes(n=16):
-    for _ in range(n):
+Request = namedtuple("Request", ["kind", "path", "content", "headers", "samples", "container", "time"])
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.error_reasons = defaultdict(int)
+        self.samples = 0
+        self.ingest_time = 0.0
+        self.finished = {}
+
+    def report(self, elapsed):
+        print(f"elapsed {elapsed:.2f} s, {self.samples} samples in {self.ingest_time:.2f} s, {rate(self.samples, self.ingest_time):.0f} samples/s")
+        for kind, latencies in sorted(self.latencies.items()):
+            print(f"{kind:>9}: {len(latencies)} requests, {len(latencies) / elapsed:.0f} req/s, "
+                  f"p50 {percentile(latencies, 50):.1f} ms, p99 {percentile(latencies, 99):.1f} ms, "
+                  f"{self.errors[kind]} errors")
+        for reason, count in sorted(self.error_reasons.items()):
+            print(f"  {count} x {reason}")
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+def rate(count, seconds):
+    # nothing is ingested when every request failed
+    return count / seconds if seconds else 0.0
+
+def generate_events(args):
+    nodes = []
+    for _ in range(args.nodes):
         instance_id = f"i-{uuid().hex[:17]}"
-        node_data = {
+        nodes.append(instance_id)
+        yield {"type": "instance", "data": {
             "instance_id": instance_id,
             "hostname": instance_id,
             "kind": random.choice(NODE_KINDS),
@@ -63,64 +86,250 @@ def generate_nodes(n=16):
             "image_id": "imageid",
             "launch_time": str(datetime.now()),
             "architecture": "x86_64",
-        }
-        r.post(INIT_URL, json=node_data)
-        print(instance_id, "initialized")
-        yield instance_id
+        }}
 
-def generate_applications(n=5):
-    for _ in range(n):
+    start = int(time.time()) - args.samples * args.interval
+    containers = []
+    for _ in range(args.apps):
         app_number = random.randint(10**12, 10**13 - 1)
-        name = f"application_{app_number}_1"
-        yield name, app_number
-
-def generate_containers(app_number, n=8):
-    for i in range(n):
-        name = f"container_{app_number}_1_1_{i}"
-        yield name
-
-def generate_container_usage(instance_id, app_name, container_name):
-    running = True
-    avg_cpu = random.randint(10, 40)
-    pid = random.randint(2000, 8000)
-    process_time = 0
-    start = datetime.now()
-    then = start
-    count = 0
-    then = datetime.now()
-    while running:
-        now = then + timedelta(seconds=2)
-        process_time += 2000
-        then = now
-
-        usage_data = {
-            "pid": pid,
-            "app": app_name,
-            "container": container_name,
-            "start": time.mktime(start.timetuple()),
-            "process_time": process_time,
-            "cpu_time": process_time / avg_cpu,
-            "cpu_usage": avg_cpu,
-            "time": time.mktime(now.timetuple()),
-        }
-        print(now, container_name, usage_data)
-        r.post(USAGE_URL.format(instance_id), json=usage_data)
-
-        count += 1
-        if count == 600:
-            time.sleep(random.randint(1, 3))
-            res = r.post(FINISHED_URL.format(container_name))
-            print(res.json())
-            running = False
+        for i in range(args.containers):
+            containers.append({
+                "instance_id": random.choice(nodes),
+                "app": f"application_{app_number}_1",
+                "container": f"container_{app_number}_1_1_{i}",
+                "pid": random.randint(2000, 8000),
+                "cpu_usage": random.randint(10, 40),
+                "process_time": 0.0,
+                "cpu_time": 0.0,
+            })
+
+    # all containers report at the same time, like agents on a cluster
+    for i in range(args.samples):
+        for c in containers:
+            c["process_time"] += c["cpu_usage"] / 100 * args.interval
+            c["cpu_time"] += args.interval
+            yield {"type": "usage", "instance_id": c["instance_id"], "data": {
+                "pid": c["pid"],
+                "app": c["app"],
+                "container": c["container"],
+                "start": float(start),
+                "process_time": c["process_time"],
+                "cpu_time": c["cpu_time"],
+                "cpu_usage": float(c["cpu_usage"]),
+                "time": start + i * args.interval,
+            }}
+    for c in containers:
+        yield {"type": "finish", "container": c["container"]}
+
+def read_events(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def record_events(events, path):
+    with open(path, "w") as f:
+        for event in events:
+            f.write(json.dumps(event) + "\n")
+            yield event
+
+def encode_batch(usages, args):
+    if args.format == "msgpack":
+        import codec
+        content = codec.pack_usage_batch(usages)
+        headers = {"Content-Type": "application/msgpack"}
+    elif args.format == "ndjson":
+        content = "".join(json.dumps(u) + "\n" for u in usages).encode()
+        headers = {"Content-Type": "application/x-ndjson"}
+    else:
+        content = json.dumps(usages).encode()
+        headers = {"Content-Type": "application/json"}
+    if args.gzip:
+        content = gzip.compress(content)
+        headers["Content-Encoding"] = "gzip"
+    return content, headers
+
+def build_requests(events, args):
+    # samples of an instance are sent in batches of args.batch, a finish
+    # event first sends the samples still pending on the container's instance
+    pending = defaultdict(list)
+    container_instances = {}
+
+    def flush(instance_id):
+        usages = pending.pop(instance_id, [])
+        if usages:
+            content, headers = encode_batch(usages, args)
+            yield Request("batch", f"/instance/{instance_id}/usage/batch", content, headers, len(usages), None, usages[-1]["time"])
+
+    for event in events:
+        if event["type"] == "instance":
+            yield Request("instance", "/instance", json.dumps(event["data"]).encode(), {"Content-Type": "application/json"}, 0, None, None)
+        elif event["type"] == "usage":
+            instance_id = event["instance_id"]
+            container_instances[event["data"]["container"]] = instance_id
+            if args.batch <= 1:
+                yield Request("usage", f"/instance/{instance_id}/usage", json.dumps(event["data"]).encode(), {"Content-Type": "application/json"}, 1, None, event["data"]["time"])
+                continue
+            pending[instance_id].append(event["data"])
+            if len(pending[instance_id]) >= args.batch:
+                yield from flush(instance_id)
+        elif event["type"] == "finish":
+            instance_id = container_instances.get(event["container"])
+            if instance_id is not None:
+                yield from flush(instance_id)
+            yield Request("finish", f"/container/{event['container']}/finish", b"finished", {"Content-Type": "text/plain"}, 0, event["container"], None)
+    for instance_id in list(pending):
+        yield from flush(instance_id)
+
+async def send(client, request, stats):
+    start = time.perf_counter()
+    error = None
+    try:
+        response = await client.post(request.path, content=request.content, headers=request.headers)
+        if response.status_code >= 400:
+            error = f"HTTP {response.status_code}"
+    except httpx.HTTPError as e:
+        error = type(e).__name__
+    stats.latencies[request.kind].append((time.perf_counter() - start) * 1000)
+    if error is not None:
+        stats.errors[request.kind] += 1
+        stats.error_reasons[f"{request.kind} {error}"] += 1
+        return
+    stats.samples += request.samples
+    if request.kind == "finish":
+        stats.finished[request.container] = time.monotonic()
+
+async def run(requests, args, stats):
+    # below the 5 s keep-alive timeout of uvicorn, reusing a connection the
+    # server is closing fails the request
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency, keepalive_expiry=2)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+        queue = asyncio.Queue(maxsize=args.concurrency * 2)
+
+        async def consume():
+            while True:
+                request = await queue.get()
+                if request is None:
+                    return
+                await send(client, request, stats)
+
+        async def drain(consumers):
+            for _ in consumers:
+                await queue.put(None)
+            await asyncio.gather(*consumers)
+
+        consumers = [asyncio.create_task(consume()) for _ in range(args.concurrency)]
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        sent = 0
+        first_time = None
+        finish_requests = []
+        for request in requests:
+            # instances are registered before any sample of theirs is sent
+            if request.kind == "instance":
+                await send(client, request, stats)
+                continue
+            # a finish racing the last samples of its container would cost
+            # it without them, finish events go out after all samples
+            if request.kind == "finish":
+                finish_requests.append(request)
+                continue
+            delay = 0
+            if args.speed > 0 and request.time is not None:
+                # replays samples at speed times the recorded rate
+                if first_time is None:
+                    first_time = request.time
+                delay = start + (request.time - first_time) / args.speed - loop.time()
+            elif args.rate > 0:
+                delay = start + sent / args.rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await queue.put(request)
+            sent += request.samples
+        await drain(consumers)
+        stats.ingest_time = loop.time() - start
+
+        consumers = [asyncio.create_task(consume()) for _ in range(args.concurrency)]
+        for request in finish_requests:
+            await queue.put(request)
+        await drain(consumers)
+
+def usage_rows_inserted(engine):
+    from sqlalchemy import text
+    with engine.connect() as connection:
+        return int(connection.scalar(text(
+            "SELECT coalesce(sum(n_tup_ins), 0) FROM pg_stat_user_tables "
+            "WHERE relname = 'usage' OR relname LIKE 'usage\\_p%'"
+        )))
+
+def wait_for_costs(engine, finished, timeout):
+    from sqlalchemy import text
+    stmt = text(
+        "SELECT container.name FROM container "
+        "JOIN container_cost ON container_cost.container_id = container.id "
+        "WHERE container.name = ANY(:names)"
+    )
+    latencies = []
+    waiting = dict(finished)
+    deadline = time.monotonic() + timeout
+    while waiting and time.monotonic() < deadline:
+        with engine.connect() as connection:
+            costed = connection.scalars(stmt, {"names": list(waiting)}).all()
+        now = time.monotonic()
+        for name in costed:
+            latencies.append((now - waiting.pop(name)) * 1000)
+        if waiting:
+            time.sleep(0.2)
+    return latencies, len(waiting)
 
 
 if __name__ == "__main__":
-    instance_ids = list(generate_nodes())
-    applications = generate_applications()
-    for app_name, app_number in applications:
-        containers = generate_containers(app_number, random.randint(5, 8)) 
-        for cname in containers:
-            instance = random.choice(instance_ids) 
-            t = Thread(target=generate_container_usage, args=(instance, app_name, cname))
-            t.start()
-            print(cname, "finished")
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://127.0.0.1:8000")
+    parser.add_argument("--nodes", type=int, default=16)
+    parser.add_argument("--apps", type=int, default=5)
+    parser.add_argument("--containers", type=int, default=8, help="per application")
+    parser.add_argument("--samples", type=int, default=600, help="per container")
+    parser.add_argument("--interval", type=int, default=2, help="seconds between samples of a container")
+    parser.add_argument("--batch", type=int, default=1, help="samples per request, 1 uses the single sample endpoint")
+    parser.add_argument("--format", choices=["json", "ndjson", "msgpack"], default="json", help="batch body format")
+    parser.add_argument("--gzip", action="store_true", help="gzip batch bodies")
+    parser.add_argument("--rate", type=float, default=0, help="samples per second, 0 for as fast as possible")
+    parser.add_argument("--concurrency", type=int, default=64, help="requests in flight")
+    parser.add_argument("--timeout", type=float, default=30)
+    parser.add_argument("--record", help="write the generated events to a JSONL file")
+    parser.add_argument("--replay", help="send the events of a JSONL recording")
+    parser.add_argument("--speed", type=float, default=0, help="send samples at this multiple of their recorded rate")
+    parser.add_argument("--no-finish", action="store_true", help="do not send finish events")
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL"), help="to measure rows/s and cost latency")
+    parser.add_argument("--cost-timeout", type=float, default=120, help="seconds to wait for container costs")
+    args = parser.parse_args()
+
+    events = read_events(args.replay) if args.replay else generate_events(args)
+    if args.record:
+        events = record_events(events, args.record)
+    if args.no_finish:
+        events = (event for event in events if event["type"] != "finish")
+
+    engine = None
+    if args.database_url:
+        from sqlalchemy import create_engine
+        engine = create_engine(args.database_url)
+        rows_before = usage_rows_inserted(engine)
+
+    stats = Stats()
+    start = time.perf_counter()
+    asyncio.run(run(build_requests(events, args), args, stats))
+    elapsed = time.perf_counter() - start
+    stats.report(elapsed)
+
+    if engine is not None:
+        if stats.finished:
+            costs_start = time.monotonic()
+            latencies, missing = wait_for_costs(engine, stats.finished, args.cost_timeout)
+            print(f"cost tasks: {len(latencies)} containers costed, p50 {percentile(latencies, 50):.0f} ms, "
+                  f"p99 {percentile(latencies, 99):.0f} ms, {missing} not costed after {time.monotonic() - costs_start:.0f} s")
+        # statistics are flushed by postgres in the background
+        time.sleep(1)
+        rows = usage_rows_inserted(engine) - rows_before
+        print(f"database: {rows} usage rows, {rate(rows, stats.ingest_time):.0f} rows/s")